@@ -0,0 +1,97 @@
+"""
+A local stand-in of the gutendex api for the load tests, with a generated catalog
+and a configurable latency, so that the benchmarks do not depend on gutendex.
+
+    python -m benchmarks.fake_gutendex [--port 8081] [--books 70000] [--page-size 32] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import random
+from typing import List
+from aiohttp import web
+
+WORDS = ["the", "adventures", "of", "sherlock", "holmes", "pride", "and", "prejudice", "tale", "two",
+         "cities", "history", "volume", "journal", "poems", "letters", "war", "peace", "life", "travels"]
+NAMES = ["Austen, Jane", "Doyle, Arthur Conan", "Dickens, Charles", "Twain, Mark", "Shelley, Mary"]
+
+
+def make_books(size: int, seed: int = 0) -> List[dict]:
+    rnd = random.Random(seed)
+    return [{
+        "id": id,
+        "title": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 6))).capitalize(),
+        "authors": [{"name": rnd.choice(NAMES), "birth_year": 1800, "death_year": 1870}],
+        "languages": ["en"],
+        "download_count": rnd.randint(0, 100000)
+    } for id in range(1, size + 1)]
+
+
+def make_app(books: List[dict], page_size: int = 32, latency: float = 0, jitter: float = 0) -> web.Application:
+    by_id = {book["id"]: book for book in books}
+    # Gutendex lists the most downloaded books first
+    ordered = sorted(books, key=lambda book: -book["download_count"])
+
+    async def delay():
+        if latency or jitter:
+            await asyncio.sleep(latency + random.uniform(0, jitter))
+
+    async def get_book(request: web.Request) -> web.Response:
+        await delay()
+        book = by_id.get(int(request.match_info["id"]))
+        if book is None:
+            return web.json_response({"detail": "Not found."}, status=404)
+        return web.json_response(book)
+
+    searches = {}
+
+    def search(terms: str) -> List[dict]:
+        # Memoized, so that the stand-in itself stays cheap under load
+        if terms not in searches:
+            results = ordered
+            for term in terms.lower().split():
+                results = [book for book in results if term in book["title"].lower()
+                           or any(term in author["name"].lower() for author in book["authors"])]
+            searches[terms] = results
+        return searches[terms]
+
+    async def list_books(request: web.Request) -> web.Response:
+        await delay()
+        results = ordered
+        if "ids" in request.query:
+            ids = [int(id) for id in request.query["ids"].split(",") if id]
+            results = sorted((by_id[id] for id in set(ids) if id in by_id),
+                             key=lambda book: -book["download_count"])
+        if "search" in request.query:
+            found = search(request.query["search"])
+            results = found if results is ordered else [book for book in results if book in found]
+        page = int(request.query.get("page", 1))
+        pages = max((len(results) + page_size - 1) // page_size, 1)
+        if page < 1 or page > pages:
+            return web.json_response({"detail": "Invalid page."}, status=404)
+        def page_url(page: int) -> str:
+            return "{}://{}{}".format(request.scheme, request.host, request.rel_url.update_query(page=page))
+        return web.json_response({
+            "count": len(results),
+            "next": page_url(page + 1) if page < pages else None,
+            "previous": page_url(page - 1) if page > 1 else None,
+            "results": results[(page - 1) * page_size:page * page_size]
+        })
+
+    app = web.Application()
+    app.router.add_get("/books/{id:\\d+}", get_book)
+    app.router.add_get("/books/", list_books)
+    app.router.add_get("/books", list_books)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--books", type=int, default=70000)
+    parser.add_argument("--page-size", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="Random seconds added on top of the latency")
+    args = parser.parse_args()
+    web.run_app(make_app(make_books(args.books), page_size=args.page_size, latency=args.latency, jitter=args.jitter),
+                host=args.host, port=args.port, print=None)
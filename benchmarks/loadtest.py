@@ -0,0 +1,234 @@
+"""
+Load tests the endpoints of the api. It starts the fake gutendex and the api (with uvicorn)
+as subprocesses, runs every scenario for a while with concurrent clients and reports the
+throughput and the latency percentiles. The results are stored by commit in bench_results/,
+so that they can be compared with the results of another commit.
+
+The api uses the mongo database of the environment settings, gutendexerBench by default,
+seed it first with `python -m benchmarks.seed_reviews`. The reviews added by the write
+scenarios are removed before the run and after every write scenario, so every run starts
+from the seeded data. The logs of the api and the fake gutendex are in bench_results/logs/.
+
+    python -m benchmarks.loadtest [--duration 10] [--concurrency 32] [--page-size 32] [--scenarios book top]
+    python -m benchmarks.loadtest --compare bench_results/<commit>.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import aiohttp
+from gutendexer.Config import Config
+from gutendexer.clients import mongo_registry
+from benchmarks.seed_reviews import reset
+
+RESULTS_DIR = Path(__file__).resolve().parent.parent / "bench_results"
+LOGS_DIR = RESULTS_DIR / "logs"
+
+# A scenario returns the method, the path and the json body of a request
+Request = Tuple[str, str, Optional[object]]
+
+
+def popular_book(books: int) -> int:
+    # Skewed like the seeded reviews, so that most requests hit reviewed books
+    return min(int(random.paretovariate(1.2)), books)
+
+
+# The scenarios that add reviews to the seeded database
+WRITE_SCENARIOS = {"review", "reviews-bulk"}
+
+
+def scenarios(books: int) -> Dict[str, Callable[[], Request]]:
+    titles = ["the", "adventures", "tale of", "history volume", "pride"]
+    return {
+        "book": lambda: ("GET", "/books/{}/".format(popular_book(books)), None),
+        "books-batch": lambda: ("GET", "/books/?ids={}".format(",".join(
+            str(popular_book(books)) for _ in range(20))), None),
+        "top": lambda: ("GET", "/books/top/?amount=10", None),
+        "search": lambda: ("GET", "/books/search/?title={}".format(random.choice(titles[2:])), None),
+        "search-paginated": lambda: ("GET", "/books/search-paginated/?title={}&page={}".format(
+            random.choice(titles), random.randint(1, 3)), None),
+        "monthly-average": lambda: ("GET", "/books/{}/monthly-average/".format(popular_book(books)), None),
+        "reviews": lambda: ("GET", "/books/{}/reviews/?limit=20".format(popular_book(books)), None),
+        "review": lambda: ("POST", "/books/{}/review/".format(popular_book(books)),
+                           {"rating": random.randint(0, 5), "review": "A load test review"}),
+        "reviews-bulk": lambda: ("POST", "/books/reviews/bulk/", [
+            {"bookId": popular_book(books), "rating": random.randint(0, 5), "review": "A load test review"}
+            for _ in range(100)]),
+    }
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[max(math.ceil(q * len(sorted_values)) - 1, 0)]
+
+
+async def run_scenario(base_url: str, make_request: Callable[[], Request], duration: float, concurrency: int, warmup: float) -> dict:
+    latencies = []
+    statuses = {}
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(base_url, connector=connector) as session:
+        async def worker(until: float, record: bool):
+            nonlocal errors
+            while time.perf_counter() < until:
+                method, path, body = make_request()
+                started = time.perf_counter()
+                try:
+                    async with session.request(method, path, json=body) as response:
+                        await response.read()
+                        status = response.status
+                except aiohttp.ClientError:
+                    status = "error"
+                if record:
+                    latencies.append(time.perf_counter() - started)
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    if status == "error" or status >= 500:
+                        errors += 1
+
+        await asyncio.gather(*[worker(time.perf_counter() + warmup, False) for _ in range(concurrency)])
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(started + duration, True) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p90": percentile(latencies, 0.9) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def start_process(args: List[str], log: Path, env: Optional[dict] = None) -> subprocess.Popen:
+    """
+    Starts a python subprocess with its output written to a log file, a pipe
+    that is not read would block the process once its buffer is full
+    """
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(log, "wb") as file:
+        return subprocess.Popen([sys.executable] + args, env=env,
+                                stdout=file, stderr=subprocess.STDOUT)
+
+
+def log_tail(log: Path, size: int = 4096) -> str:
+    with open(log, "rb") as file:
+        file.seek(max(log.stat().st_size - size, 0))
+        return file.read().decode(errors="replace")
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, log: Path, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("{} exited: {}".format(url, log_tail(log)))
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("{} did not start in {}s".format(url, timeout))
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None):
+    print("{:>18} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+        "scenario", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms"))
+    for name, result in results.items():
+        print("{:>18} {:>9} {:>7} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, result["requests"], result["errors"], result["throughput"], result["p50"], result["p90"], result["p99"]))
+        if baseline is not None and name in baseline:
+            base = baseline[name]
+            print("{:>18} {:>9} {:>7} {:>+9.1f}% {:>+8.1f}% {:>+8.1f}% {:>+8.1f}%".format(
+                "vs baseline", "", "", *[100 * (result[key] - base[key]) / base[key] if base[key] else float("nan")
+                                         for key in ["throughput", "p50", "p90", "p99"]]))
+
+
+async def reset_database():
+    removed = await reset(mongo_registry.client.get_default_database())
+    if removed:
+        print("Removed {} reviews added after the seeding".format(removed))
+
+
+async def run(args: argparse.Namespace):
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    gutendex_url = "http://127.0.0.1:{}/books".format(args.gutendex_port)
+    api_url = "http://127.0.0.1:{}".format(args.port)
+    database = os.environ.get("DATABASE", "gutendexerBench")
+    env = dict(os.environ, GUTENDEX_URL=gutendex_url, DATABASE=database)
+    Config.DATABASE = database
+    await reset_database()
+    gutendex_log, api_log = LOGS_DIR / "fake_gutendex.log", LOGS_DIR / "api.log"
+    gutendex = start_process(["-m", "benchmarks.fake_gutendex", "--port", str(args.gutendex_port),
+                              "--books", str(args.books), "--page-size", str(args.page_size),
+                              "--latency", str(args.latency), "--jitter", str(args.jitter)], log=gutendex_log)
+    api = start_process(["-m", "uvicorn", "gutendexer.main:app", "--port", str(args.port),
+                         "--workers", str(args.workers), "--log-level", "warning"], log=api_log, env=env)
+    try:
+        await wait_until_up(gutendex_url + "/1", gutendex, log=gutendex_log)
+        await wait_until_up(api_url + "/", api, log=api_log)
+        all_scenarios = scenarios(args.books)
+        results = {}
+        for name in args.scenarios or list(all_scenarios):
+            results[name] = await run_scenario(api_url, all_scenarios[name], duration=args.duration,
+                                               concurrency=args.concurrency, warmup=args.warmup)
+            if name in WRITE_SCENARIOS:  # So that the next scenarios read the seeded data only
+                await reset_database()
+        print_results(results, baseline)
+    finally:
+        for process in (api, gutendex):
+            process.terminate()
+            process.wait()
+        mongo_registry.close()
+
+    commit = git_commit()
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / "{}.json".format(commit)
+    with open(path, "w") as file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.utcnow().isoformat(),
+            "settings": {key: value for key, value in vars(args).items() if key != "compare"},
+            "results": results
+        }, file, indent=2)
+    print("Results stored in {}".format(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(scenarios(1)))
+    parser.add_argument("--duration", type=float, default=10, help="Seconds every scenario is measured")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds every scenario runs before being measured")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--books", type=int, default=70000)
+    parser.add_argument("--page-size", type=int, default=32, help="Books per page of the fake gutendex")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of the fake gutendex in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Random latency of the fake gutendex in seconds")
+    parser.add_argument("--workers", type=int, default=1, help="Uvicorn workers of the api")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--gutendex-port", type=int, default=8081)
+    parser.add_argument("--compare", help="Results file of another commit to compare with")
+    asyncio.run(run(parser.parse_args()))
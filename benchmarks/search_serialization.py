@@ -0,0 +1,74 @@
+"""
+Benchmarks the serialization of the /books/search/ responses, the default FastAPI
+path (response_model validation and jsonable_encoder) against FastJSONResponse.
+
+    python -m benchmarks.search_serialization [--sizes 1000 10000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from gutendexer.routes import responses
+from gutendexer.routes.responses import FastJSONResponse
+from gutendexer.schemas.book import BookBase
+
+
+def make_books_data(size: int) -> List[dict]:
+    return [{
+        "id": id,
+        "title": "The title of the book number {}".format(id),
+        "authors": [{"name": "Author, Some", "birth_year": 1800, "death_year": 1870}],
+        "languages": ["en"],
+        "download_count": id * 10
+    } for id in range(size)]
+
+
+async def default_response(field, books: List[BookBase]) -> bytes:
+    content = await serialize_response(field=field, response_content=books)
+    return JSONResponse(content=content).body
+
+
+async def fast_response(field, books: List[BookBase]) -> bytes:
+    return FastJSONResponse(books).body
+
+
+async def best_of(call, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = call()
+        if asyncio.iscoroutine(result):
+            await result
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+async def run(sizes: List[int], repeat: int):
+    field = create_response_field(name="Response_search", type_=List[BookBase])
+    orjson = responses.orjson
+    print("{:>8} {:>12} {:>14} {:>14} {:>14}".format(
+        "books", "build (ms)", "default (ms)", "orjson (ms)", "json (ms)"))
+    for size in sizes:
+        books_data = make_books_data(size)
+        build = await best_of(lambda: [BookBase(**book) for book in books_data], repeat)
+        books = [BookBase(**book) for book in books_data]
+        default = await best_of(lambda: default_response(field, books), repeat)
+        fast = await best_of(lambda: fast_response(field, books), repeat) if orjson is not None else float("nan")
+        responses.orjson = None
+        try:
+            fallback = await best_of(lambda: fast_response(field, books), repeat)
+        finally:
+            responses.orjson = orjson
+        print("{:>8} {:>12.1f} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+            size, build, default, fast, fallback))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(sizes=args.sizes, repeat=args.repeat))
@@ -0,0 +1,75 @@
+"""
+Seeds a mongo database with generated reviews for the load tests, and builds
+their rating summaries and indexes like the api expects them.
+The mongo connection settings are taken from the environment, like the api.
+
+    python -m benchmarks.seed_reviews [--database gutendexerBench] [--reviews 2000000] [--books 70000]
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from gutendexer.Config import Config
+from gutendexer.clients import mongo_registry
+from gutendexer.crud.stats import rebuild_book_stats
+from gutendexer.indexes import ensure_indexes
+
+REVIEWS = ["A classic", "Could not put it down", "Too long", "Beautifully written", None]
+# The seeded reviews are created in this span, the reviews added later by the load tests after it
+SEEDED_FROM = datetime(2015, 1, 1)
+SEEDED_UNTIL = datetime(2023, 1, 1)
+
+
+async def seed(reviews: int, books: int, batch_size: int, seed: int = 0):
+    rnd = random.Random(seed)
+    db = mongo_registry.client.get_default_database()
+    await db.reviews.delete_many({})
+    await ensure_indexes(db)
+    span = (SEEDED_UNTIL - SEEDED_FROM).total_seconds()
+    inserted = 0
+    while inserted < reviews:
+        batch = [{
+            # Skewed towards the first books, like the popularity of the real catalog
+            "bookId": min(int(rnd.paretovariate(1.2)), books),
+            "rating": rnd.randint(0, 5),
+            "review": rnd.choice(REVIEWS),
+            "createdAt": SEEDED_FROM + timedelta(seconds=rnd.uniform(0, span))
+        } for _ in range(min(batch_size, reviews - inserted))]
+        await db.reviews.insert_many(batch, ordered=False)
+        inserted += len(batch)
+        print("{} reviews inserted".format(inserted), end="\r", flush=True)
+    print()
+    return await rebuild_book_stats(db)
+
+
+async def reset(db) -> int:
+    """
+    Removes the reviews that were added after the seeding, e.g. by the write scenarios
+    of the load tests, and rebuilds the rating summaries if there were any, so that
+    every load test runs against the same data. Returns the amount of reviews removed.
+    """
+    removed = (await db.reviews.delete_many({"createdAt": {"$gte": SEEDED_UNTIL}})).deleted_count
+    if removed:
+        await rebuild_book_stats(db)
+    return removed
+
+
+async def run(args: argparse.Namespace):
+    Config.DATABASE = args.database
+    try:
+        started = time.perf_counter()
+        books = await seed(reviews=args.reviews, books=args.books, batch_size=args.batch_size)
+        print("{} reviews of {} books seeded in {:.1f}s".format(
+            args.reviews, books, time.perf_counter() - started))
+    finally:
+        mongo_registry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="gutendexerBench")
+    parser.add_argument("--reviews", type=int, default=2000000)
+    parser.add_argument("--books", type=int, default=70000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    asyncio.run(run(parser.parse_args()))
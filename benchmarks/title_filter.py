@@ -0,0 +1,66 @@
+"""
+Benchmarks the title filter of the search results, filter_title per book
+against a TitleMatcher built once per search that filters whole pages.
+
+    python -m benchmarks.title_filter [--titles 50000] [--repeat 5]
+"""
+import argparse
+import random
+import time
+from gutendexer.crud.utils import TitleMatcher, filter_title
+
+WORDS = ["the", "adventures", "of", "sherlock", "holmes", "pride", "and", "prejudice", "tale",
+         "two", "cities", "cafe", "wonderland", "history", "volume", "journal", "poems", "letters"]
+# Most gutenberg titles are plain ascii, some have accents
+ACCENTED_WORDS = ["café", "société", "über", "straße", "élégie", "mémoires"]
+ACCENTED_SHARE = 0.1
+SEARCHES = ["the", "adventures of", "tale of two cities", "history volume the", "cafe"]
+PAGE_SIZE = 32
+
+
+def make_books(size: int) -> list:
+    rnd = random.Random(0)
+    books = []
+    for id in range(size):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(2, 8))]
+        if rnd.random() < ACCENTED_SHARE:
+            words[rnd.randrange(len(words))] = rnd.choice(ACCENTED_WORDS)
+        books.append({"id": id, "title": " ".join(word.capitalize() for word in words)})
+    return books
+
+
+def best_of(call, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def run(titles: int, repeat: int):
+    books = make_books(titles)
+    pages = [books[i:i + PAGE_SIZE] for i in range(0, len(books), PAGE_SIZE)]
+
+    def with_filter_title(search: str) -> list:
+        return [book for page in pages for book in page if filter_title(title=book["title"], search_string=search)]
+
+    def with_matcher(search: str) -> list:
+        matcher = TitleMatcher(search)
+        return [book for page in pages for book in matcher.filter(page)]
+
+    print("{} titles in pages of {}".format(titles, PAGE_SIZE))
+    print("{:>22} {:>18} {:>18} {:>10}".format("search", "filter_title (ms)", "TitleMatcher (ms)", "matches"))
+    for search in SEARCHES:
+        old = best_of(lambda: with_filter_title(search), repeat)
+        new = best_of(lambda: with_matcher(search), repeat)
+        print("{:>22} {:>18.1f} {:>18.1f} {:>10}".format(
+            search, old, new, "{}/{}".format(len(with_filter_title(search)), len(with_matcher(search)))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--titles", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(titles=args.titles, repeat=args.repeat)
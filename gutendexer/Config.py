@@ -15,5 +15,113 @@ class Config(object):
     DATABASE = os.getenv("DATABASE", "gutendexer")
     DATABASE_TEST = os.getenv("DATABASE_TEST", "gutendexerTest")
 
+    # MONGODB connection pool variables
+    MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+    MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+    MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+        os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+    # Create the missing indexes on startup
+    MONGO_ENSURE_INDEXES = os.getenv(
+        "MONGO_ENSURE_INDEXES", "true").lower() == "true"
+
+    # Cache-Control max-age (seconds) of the read endpoints
+    BOOK_MAX_AGE = int(os.getenv("BOOK_MAX_AGE", 60))
+    TOP_BOOKS_MAX_AGE = int(os.getenv("TOP_BOOKS_MAX_AGE", 300))
+    MONTHLY_AVERAGE_MAX_AGE = int(os.getenv("MONTHLY_AVERAGE_MAX_AGE", 300))
+
+    # Opt-in request profiling, with the header or for a sampled fraction of the requests
+    PROFILING = os.getenv("PROFILING", "false").lower() == "true"
+    PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+    # The value the profile header must have, profiling with the header is disabled without it
+    PROFILE_SECRET = os.getenv("PROFILE_SECRET")
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+    # Log the aggregations slower than this (milliseconds) with their explain output
+    SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS")) if os.getenv(
+        "SLOW_QUERY_MS") else None
+    SLOW_QUERY_EXPLAIN_VERBOSITY = os.getenv(
+        "SLOW_QUERY_EXPLAIN_VERBOSITY", "queryPlanner")
+
+    # Amount of latest reviews included in a book
+    BOOK_REVIEWS_LIMIT = int(os.getenv("BOOK_REVIEWS_LIMIT", 10))
+    # Maximum amount of books requested at once by ids
+    BOOKS_BATCH_MAX_SIZE = int(os.getenv("BOOKS_BATCH_MAX_SIZE", 100))
+    # Maximum amount of reviews in a page of the reviews of a book
+    REVIEWS_PAGE_MAX_SIZE = int(os.getenv("REVIEWS_PAGE_MAX_SIZE", 100))
+    # Amount of reviews inserted with one insert_many by the bulk review import
+    BULK_REVIEWS_BATCH_SIZE = int(os.getenv("BULK_REVIEWS_BATCH_SIZE", 1000))
+
+    # Acknowledge the reviews and insert them in batches from a background task (write-behind)
+    REVIEW_WRITE_BEHIND = os.getenv(
+        "REVIEW_WRITE_BEHIND", "false").lower() == "true"
+    REVIEW_BUFFER_MAX_SIZE = int(os.getenv("REVIEW_BUFFER_MAX_SIZE", 10000))
+    REVIEW_BUFFER_BATCH_SIZE = int(os.getenv("REVIEW_BUFFER_BATCH_SIZE", 500))
+    REVIEW_BUFFER_FLUSH_INTERVAL_MS = int(
+        os.getenv("REVIEW_BUFFER_FLUSH_INTERVAL_MS", 100))
+    # Write concern of the buffered inserts, a number of nodes or "majority"
+    REVIEW_BUFFER_WRITE_CONCERN = os.getenv("REVIEW_BUFFER_WRITE_CONCERN", "1")
+
     # Gutendex related variables
     GUTENDEX_URL = os.getenv("GUTENDEX_URL", "http://gutendex.com/books")
+    GUTENDEX_CONNECTION_LIMIT = int(os.getenv("GUTENDEX_CONNECTION_LIMIT", 100))
+    GUTENDEX_CONNECTION_LIMIT_PER_HOST = int(
+        os.getenv("GUTENDEX_CONNECTION_LIMIT_PER_HOST", 20))
+    GUTENDEX_KEEPALIVE_TIMEOUT = float(
+        os.getenv("GUTENDEX_KEEPALIVE_TIMEOUT", 30))
+    GUTENDEX_DNS_CACHE_TTL = int(os.getenv("GUTENDEX_DNS_CACHE_TTL", 300))
+    # Maximum number of concurrent gutendex requests issued by a single api request
+    GUTENDEX_CONCURRENCY = int(os.getenv("GUTENDEX_CONCURRENCY", 8))
+    # Fetch all the pages of a search concurrently once the first page tells the total count
+    GUTENDEX_PARALLEL_PAGES = os.getenv(
+        "GUTENDEX_PARALLEL_PAGES", "true").lower() == "true"
+    # Amount of ids sent in one gutendex `ids=` request, gutendex pages by 32 books
+    GUTENDEX_IDS_CHUNK_SIZE = int(os.getenv("GUTENDEX_IDS_CHUNK_SIZE", 32))
+    # Retries of a failed gutendex request, with exponential backoff (seconds) and jitter
+    GUTENDEX_RETRIES = int(os.getenv("GUTENDEX_RETRIES", 2))
+    GUTENDEX_BACKOFF_BASE = float(os.getenv("GUTENDEX_BACKOFF_BASE", 0.1))
+    GUTENDEX_BACKOFF_MAX = float(os.getenv("GUTENDEX_BACKOFF_MAX", 2))
+    # Consecutive failures that open the circuit, and seconds before gutendex is tried again
+    GUTENDEX_BREAKER_THRESHOLD = int(os.getenv("GUTENDEX_BREAKER_THRESHOLD", 5))
+    GUTENDEX_BREAKER_RESET_TIMEOUT = float(
+        os.getenv("GUTENDEX_BREAKER_RESET_TIMEOUT", 30))
+    # Timeout of a single attempt, unset to use GUTENDEX_TIMEOUT
+    GUTENDEX_ATTEMPT_TIMEOUT = float(os.getenv("GUTENDEX_ATTEMPT_TIMEOUT")) if os.getenv(
+        "GUTENDEX_ATTEMPT_TIMEOUT") else None
+    # Seconds after which a second, hedged, request is sent if gutendex has not answered, unset to disable
+    GUTENDEX_HEDGE_DELAY = float(os.getenv("GUTENDEX_HEDGE_DELAY")) if os.getenv(
+        "GUTENDEX_HEDGE_DELAY") else None
+    # Seconds to wait for gutendex before a book is returned with its ratings only, unset to always wait
+    GUTENDEX_DEADLINE = float(os.getenv("GUTENDEX_DEADLINE")) if os.getenv(
+        "GUTENDEX_DEADLINE") else None
+    # Timeouts (in seconds) applied to every gutendex request
+    GUTENDEX_TIMEOUT = float(os.getenv("GUTENDEX_TIMEOUT", 30))
+    GUTENDEX_CONNECT_TIMEOUT = float(os.getenv("GUTENDEX_CONNECT_TIMEOUT", 5))
+    GUTENDEX_READ_TIMEOUT = float(os.getenv("GUTENDEX_READ_TIMEOUT", 15))
+
+    # Cache of the gutendex book data
+    BOOK_CACHE_TTL = float(os.getenv("BOOK_CACHE_TTL", 24 * 60 * 60))
+    BOOK_CACHE_MAX_SIZE = int(os.getenv("BOOK_CACHE_MAX_SIZE", 10000))
+    # Seconds an expired book is still served while it is refreshed in the background, 0 disables it
+    BOOK_CACHE_MAX_STALE = float(os.getenv("BOOK_CACHE_MAX_STALE", 24 * 60 * 60))
+    # Also keep the book data in a mongo collection shared by all the api processes
+    BOOK_CACHE_SHARED = os.getenv("BOOK_CACHE_SHARED", "false").lower() == "true"
+
+    # Cache of the gutendex search pages
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 60 * 60))
+    SEARCH_CACHE_MAX_SIZE = int(os.getenv("SEARCH_CACHE_MAX_SIZE", 1000))
+    SEARCH_CACHE_MAX_BYTES = int(
+        os.getenv("SEARCH_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+    # Largest page size that can be requested from the paginated search
+    SEARCH_PAGE_MAX_SIZE = int(os.getenv("SEARCH_PAGE_MAX_SIZE", 100))
+    # Fetch the gutendex pages of the next page of a paginated search in the background
+    SEARCH_PREFETCH = os.getenv("SEARCH_PREFETCH", "true").lower() == "true"
+
+    # Answer the title searches from the local gutenberg catalog instead of gutendex
+    LOCAL_CATALOG = os.getenv("LOCAL_CATALOG", "false").lower() == "true"
+    CATALOG_COLLECTION = os.getenv("CATALOG_COLLECTION", "catalog")
+    CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", 32))
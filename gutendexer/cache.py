@@ -0,0 +1,256 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+from pymongo import ReplaceOne
+from .Config import Config
+from .clients import mongo_registry
+
+
+class LRUCache(object):
+    """
+    In-process cache with a time to live per entry and a bound on the number of entries.
+    Optionally, the total size (in bytes, as given on set) of the entries is bounded too.
+    When full, the least recently used entries are evicted. Expired entries are kept
+    until evicted, so they can still be served stale, e.g. while gutendex is down.
+    """
+
+    def __init__(self, max_size: int, ttl: float, max_bytes: Optional[int] = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def get_stale(self, key: Hashable, max_stale: Optional[float] = None) -> Optional[Any]:
+        """
+        Returns the value of the key even if it has expired,
+        or, with max_stale, if it expired at most max_stale seconds ago
+        """
+        entry = self._entries.get(key)
+        if entry is None or (max_stale is not None and entry[1] + max_stale < time.monotonic()):
+            return None
+        self.stale_hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, size: int = 0):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl, size)
+        self.bytes += size
+        while len(self._entries) > self.max_size or (
+                self.max_bytes is not None and self.bytes > self.max_bytes and self._entries):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        stats = {"hits": self.hits, "misses": self.misses,
+                 "staleHits": self.stale_hits, "size": len(self._entries)}
+        if self.max_bytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
+
+
+class SingleFlight(object):
+    """
+    Makes concurrent calls with the same key share one execution of the call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def start(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Starts the call of the key, unless it is already in flight, without waiting for it
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        return future
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        # A cancelled caller should not cancel the call for the rest of them
+        return await asyncio.shield(self.start(key, call))
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class SearchCache(object):
+    """
+    Cache of the gutendex search pages, keyed by the normalized search string and the page.
+    Concurrent identical searches that miss the cache share one gutendex request.
+    The metadata of the searches (count and page size) are kept separately by
+    normalized search string, since they are needed for every page.
+    """
+
+    def __init__(self, cache: LRUCache, meta: Optional[LRUCache] = None):
+        self.cache = cache
+        self.meta = meta if meta is not None else LRUCache(max_size=cache.max_size, ttl=cache.ttl)
+        self.flights = SingleFlight()
+
+    @staticmethod
+    def key(search: str, page: int) -> Tuple[str, int]:
+        return " ".join(search.lower().split()), page
+
+    async def get_or_fetch(self, key: Tuple[str, int], fetch: Callable[[], Awaitable[Tuple[Any, int]]]) -> Any:
+        """
+        Returns the cached value of the key, otherwise awaits fetch, that returns
+        the value and its size in bytes, and caches it.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        async def fetch_and_set():
+            value, size = await fetch()
+            self.cache.set(key, value, size=size)
+            return value
+        return await self.flights.do(key, fetch_and_set)
+
+    async def clear(self):
+        self.cache.clear()
+        self.meta.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class MongoCache(object):
+    """
+    Cache shared by all the api processes, stored in a mongo collection.
+    The expired entries are ignored on read.
+    """
+
+    def __init__(self, collection_name: str, ttl: float):
+        self.collection_name = collection_name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def collection(self):
+        return mongo_registry.client.get_default_database()[self.collection_name]
+
+    async def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        keys = list(keys)
+        found = {}
+        async for doc in self.collection.find({"_id": {"$in": keys}, "expiresAt": {"$gt": datetime.utcnow()}}):
+            found[doc["_id"]] = doc["value"]
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set_many(self, values: Dict[Hashable, Any]):
+        if not values:
+            return
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        # One round trip for the whole batch
+        await self.collection.bulk_write([
+            ReplaceOne({"_id": key}, {"_id": key, "value": value, "expiresAt": expires_at}, upsert=True)
+            for key, value in values.items()
+        ], ordered=False)
+
+    async def clear(self):
+        await self.collection.delete_many({})
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class BookCache(object):
+    """
+    Cache of the gutendex book data by book id, since gutenberg metadata almost never changes.
+    An in-process LRU cache is always used, and optionally a shared mongo cache behind it.
+    """
+
+    def __init__(self, local: LRUCache, shared: Optional[MongoCache] = None):
+        self.local = local
+        self.shared = shared
+
+    async def get_many(self, bookIds: Iterable[int]) -> Dict[int, dict]:
+        found = {}
+        missing = []
+        for bookId in bookIds:
+            book_data = self.local.get(bookId)
+            if book_data is None:
+                missing.append(bookId)
+            else:
+                found[bookId] = book_data
+        if missing and self.shared is not None:
+            shared_found = await self.shared.get_many(missing)
+            for bookId, book_data in shared_found.items():
+                self.local.set(bookId, book_data)
+            found.update(shared_found)
+        return found
+
+    async def get(self, bookId: int) -> Optional[dict]:
+        return (await self.get_many([bookId])).get(bookId)
+
+    def get_stale(self, bookId: int, max_stale: Optional[float] = None) -> Optional[dict]:
+        """
+        Returns the locally cached book data even if it has expired,
+        or, with max_stale, if it expired at most max_stale seconds ago
+        """
+        return self.local.get_stale(bookId, max_stale=max_stale)
+
+    async def set_many(self, books_data: Dict[int, dict]):
+        for bookId, book_data in books_data.items():
+            self.local.set(bookId, book_data)
+        if self.shared is not None:
+            await self.shared.set_many(books_data)
+
+    async def set(self, bookId: int, book_data: dict):
+        await self.set_many({bookId: book_data})
+
+    async def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            await self.shared.clear()
+
+    def stats(self) -> dict:
+        stats = {"local": self.local.stats()}
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+
+book_cache = BookCache(
+    local=LRUCache(max_size=Config.BOOK_CACHE_MAX_SIZE,
+                   ttl=Config.BOOK_CACHE_TTL),
+    shared=MongoCache(collection_name="bookCache", ttl=Config.BOOK_CACHE_TTL) if Config.BOOK_CACHE_SHARED else None)
+
+search_cache = SearchCache(
+    cache=LRUCache(max_size=Config.SEARCH_CACHE_MAX_SIZE,
+                   ttl=Config.SEARCH_CACHE_TTL,
+                   max_bytes=Config.SEARCH_CACHE_MAX_BYTES))
@@ -0,0 +1,192 @@
+import csv
+import json
+import re
+from typing import Dict, Iterable, Iterator, List, Set
+from pymongo import ReplaceOne
+from .Config import Config
+from .cache import SingleFlight
+from .clients import mongo_registry
+from .crud.utils import TitleMatcher, normalize_title
+
+# Maximum length of the title n-grams that are indexed
+GRAM_SIZE = 3
+
+
+def parse_csv_authors(authors: str) -> List[dict]:
+    """
+    Parses the authors column of the gutenberg csv catalog,
+    e.g. "Austen, Jane, 1775-1817; Doe, John"
+    """
+    result = []
+    for author in filter(None, (a.strip() for a in authors.split(";"))):
+        match = re.match(r"^(.*?),\s*(\d+)?\??\s*-\s*(\d+)?\??$", author)
+        if match:
+            result.append({
+                "name": match.group(1),
+                "birth_year": int(match.group(2)) if match.group(2) else None,
+                "death_year": int(match.group(3)) if match.group(3) else None
+            })
+        else:
+            result.append({"name": author, "birth_year": None, "death_year": None})
+    return result
+
+
+def load_dump(path: str) -> Iterator[dict]:
+    """
+    Reads a gutenberg catalog dump and yields the books in the gutendex format.
+    Supported dumps are the gutenberg csv catalog (pg_catalog.csv),
+    a json list of gutendex books or a gutendex page, and json lines of gutendex books.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if row.get("Type", "Text") != "Text":
+                    continue
+                yield {
+                    "id": int(row["Text#"]),
+                    "title": " ".join(row["Title"].split()),
+                    "authors": parse_csv_authors(row.get("Authors", "")),
+                    "languages": [l.strip() for l in row.get("Language", "").split(";") if l.strip()],
+                    "download_count": 0
+                }
+    elif path.endswith(".jsonl") or path.endswith(".ndjson"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        yield from data["results"] if isinstance(data, dict) else data
+
+
+def catalog_collection():
+    return mongo_registry.client.get_default_database()[Config.CATALOG_COLLECTION]
+
+
+async def ingest(books: Iterable[dict], batch_size: int = 1000) -> int:
+    """
+    Stores the books in the catalog collection, replacing the existing ones.
+    Returns the amount of books stored.
+    """
+    collection = catalog_collection()
+    count = 0
+    batch = []
+    for book in books:
+        book = {
+            "_id": book["id"],
+            "id": book["id"],
+            "title": book["title"] or "",
+            "authors": book.get("authors", []),
+            "languages": book.get("languages", []),
+            "download_count": book.get("download_count") or 0
+        }
+        batch.append(ReplaceOne({"_id": book["_id"]}, book, upsert=True))
+        if len(batch) >= batch_size:
+            await collection.bulk_write(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        await collection.bulk_write(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+def title_grams(text: str) -> Set[str]:
+    """
+    Returns all the n-grams (of length 1 up to GRAM_SIZE) of a normalized text
+    """
+    return {text[i:i + n] for n in range(1, GRAM_SIZE + 1) for i in range(len(text) - n + 1)}
+
+
+class TitleIndex(object):
+    """
+    Inverted index of the catalog titles, from title n-grams to book ids.
+    A search term is looked up by its own n-grams and the candidates are
+    verified with a TitleMatcher, so the results are exactly the books whose
+    title contains all the search terms, like the gutendex search is post filtered.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._titles: Dict[int, str] = {}
+        # All the book ids, most downloaded first like the gutendex default order
+        self._order: List[int] = []
+        # The position of every book id in that order
+        self._rank: Dict[int, int] = {}
+
+    def build(self, books: Iterable[dict]):
+        postings = {}
+        titles = {}
+        popularity = {}
+        for book in books:
+            titles[book["id"]] = book["title"]
+            popularity[book["id"]] = book.get("download_count") or 0
+            for gram in title_grams(normalize_title(book["title"])):
+                postings.setdefault(gram, set()).add(book["id"])
+        self._postings = postings
+        self._titles = titles
+        self._order = sorted(titles, key=lambda id: (-popularity[id], id))
+        self._rank = {id: rank for rank, id in enumerate(self._order)}
+
+    def __len__(self):
+        return len(self._titles)
+
+    def search(self, search_string: str) -> List[int]:
+        """
+        Returns the ids of the books whose title matches the search string, most downloaded first
+        """
+        candidates = None
+        matcher = TitleMatcher(search_string)
+        for term in matcher.terms:
+            if len(term) <= GRAM_SIZE:
+                grams = [term]
+            else:
+                grams = [term[i:i + GRAM_SIZE]
+                         for i in range(len(term) - GRAM_SIZE + 1)]
+            for gram in grams:
+                ids = self._postings.get(gram, set())
+                candidates = set(ids) if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+        # Only the candidates are ordered, not the whole catalog
+        ids = self._order if candidates is None else sorted(candidates, key=self._rank.__getitem__)
+        return [id for id in ids if matcher.match(self._titles[id])]
+
+
+class Catalog(object):
+    """
+    The local gutenberg catalog, the index is built from the catalog collection on first use.
+    It is not rebuilt when the collection changes, the api has to be restarted to index a new ingest.
+    """
+
+    def __init__(self):
+        self.index = None
+        self._loading = SingleFlight()
+
+    async def load(self) -> TitleIndex:
+        index = TitleIndex()
+        index.build([book async for book in catalog_collection().find(
+            {}, {"id": 1, "title": 1, "download_count": 1})])
+        self.index = index
+        return index
+
+    async def get_index(self) -> TitleIndex:
+        if self.index is None:
+            return await self._loading.do("index", self.load)
+        return self.index
+
+    async def search(self, search_string: str) -> List[int]:
+        return (await self.get_index()).search(search_string)
+
+    async def get_books(self, ids: List[int]) -> List[dict]:
+        """
+        Returns the books of the ids from the catalog collection, in the order of the ids
+        """
+        books = {}
+        async for book in catalog_collection().find({"_id": {"$in": ids}}, {"_id": 0}):
+            books[book["id"]] = book
+        return [books[id] for id in ids if id in books]
+
+
+catalog = Catalog()
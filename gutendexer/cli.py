@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+from .catalog import ingest, load_dump
+from .clients import mongo_registry
+from .crud.stats import rebuild_book_stats
+from .indexes import missing_indexes, rebuild_indexes
+
+
+async def ingest_catalog(args):
+    count = await ingest(load_dump(args.path), batch_size=args.batch_size)
+    print("Ingested {} books into the catalog, restart the api to index them".format(count))
+
+
+async def indexes(args):
+    db = mongo_registry.client.get_default_database()
+    if args.action == "rebuild":
+        await rebuild_indexes(db)
+        print("Rebuilt the indexes")
+        return
+    missing = await missing_indexes(db)
+    if missing:
+        for collection, names in missing.items():
+            print("Missing indexes on {}: {}".format(
+                collection, ", ".join(names)))
+        raise SystemExit(1)
+    print("All the indexes exist")
+
+
+async def rebuild_stats(args):
+    count = await rebuild_book_stats(mongo_registry.client.get_default_database())
+    print("Rebuilt the rating summaries of {} books".format(count))
+
+
+async def run(args):
+    try:
+        await args.func(args)
+    finally:
+        mongo_registry.close()
+
+
+def main(argv=None):
+    """
+    Management commands of the api, e.g.
+
+    python -m gutendexer.cli ingest-catalog pg_catalog.csv
+    python -m gutendexer.cli indexes verify
+    python -m gutendexer.cli rebuild-stats
+    """
+    parser = argparse.ArgumentParser(
+        prog="gutendexer", description="Gutendexer management commands")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    ingest_parser = subparsers.add_parser(
+        "ingest-catalog", help="Load a gutenberg catalog dump (csv, json or json lines) into the local catalog")
+    ingest_parser.add_argument("path")
+    ingest_parser.add_argument("--batch-size", type=int, default=1000)
+    ingest_parser.set_defaults(func=ingest_catalog)
+
+    indexes_parser = subparsers.add_parser(
+        "indexes", help="Verify that the required mongo indexes exist, or drop and rebuild them")
+    indexes_parser.add_argument("action", choices=["verify", "rebuild"])
+    indexes_parser.set_defaults(func=indexes)
+
+    stats_parser = subparsers.add_parser(
+        "rebuild-stats", help="Recompute the rating summaries of the books from the existing reviews")
+    stats_parser.set_defaults(func=rebuild_stats)
+
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
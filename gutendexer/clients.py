@@ -0,0 +1,97 @@
+import aiohttp
+import motor.motor_asyncio
+from .Config import Config
+from .metrics import mongo_pool_listener
+
+
+class MongoClientRegistry(object):
+    """
+    Holds the single, pooled mongo client of the process.
+    The client is created at application startup and closed on shutdown,
+    every request only borrows a session from its connection pool.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    def connect(self) -> motor.motor_asyncio.AsyncIOMotorClient:
+        """
+        Creates the client if it does not exist yet and returns it
+        """
+        if self._client is None:
+            self._client = motor.motor_asyncio.AsyncIOMotorClient(
+                "mongodb://{}:{}@{}/{}".format(
+                    Config.MONGO_USER, Config.MONGO_PASSWORD, Config.MONGO_HOST, Config.DATABASE),
+                maxPoolSize=Config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=Config.MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=Config.MONGO_MAX_IDLE_TIME_MS,
+                connectTimeoutMS=Config.MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=Config.MONGO_SOCKET_TIMEOUT_MS,
+                serverSelectionTimeoutMS=Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                readPreference=Config.MONGO_READ_PREFERENCE,
+                event_listeners=[mongo_pool_listener])
+        return self._client
+
+    @property
+    def client(self) -> motor.motor_asyncio.AsyncIOMotorClient:
+        # Lazily connect, so that code running outside the app lifespan (tests, scripts) still works
+        return self.connect()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class HttpSessionRegistry(object):
+    """
+    Holds the single aiohttp session that is used to contact gutendex.
+    Sharing it keeps the connections to gutendex warm (keep-alive)
+    and the DNS lookups cached between requests.
+    """
+
+    def __init__(self):
+        self._session = None
+
+    def connect(self) -> aiohttp.ClientSession:
+        """
+        Creates the session if it does not exist yet and returns it.
+        It has to be called from inside the running event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=Config.GUTENDEX_CONNECTION_LIMIT,
+                limit_per_host=Config.GUTENDEX_CONNECTION_LIMIT_PER_HOST,
+                keepalive_timeout=Config.GUTENDEX_KEEPALIVE_TIMEOUT,
+                use_dns_cache=True,
+                ttl_dns_cache=Config.GUTENDEX_DNS_CACHE_TTL)
+            timeout = aiohttp.ClientTimeout(
+                total=Config.GUTENDEX_TIMEOUT,
+                connect=Config.GUTENDEX_CONNECT_TIMEOUT,
+                sock_read=Config.GUTENDEX_READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout)
+        return self._session
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.connect()
+
+    def pool_stats(self) -> dict:
+        """
+        Returns the number of connections in use and the limit of the connection pool
+        """
+        if self._session is None or self._session.closed:
+            return {"acquired": 0, "limit": Config.GUTENDEX_CONNECTION_LIMIT}
+        connector = self._session.connector
+        # aiohttp has no public counter of the connections in use
+        return {"acquired": len(getattr(connector, "_acquired", ())), "limit": connector.limit}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+mongo_registry = MongoClientRegistry()
+http_registry = HttpSessionRegistry()
@@ -1,88 +1,249 @@
 from fastapi import HTTPException
 import aiohttp
-from typing import List
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Union
 from motor.motor_tornado import MotorClientSession
-from ..schemas.review import Review, ReviewCreate
-from ..schemas.book import AverageMonthlyRating, Book, BookAverageMonthlyRating, BookBase, PaginatedBookList
+from ..schemas.review import BookReview, PaginatedReviewList, Review, ReviewCreate
+from ..schemas.book import AverageMonthlyRating, Book, BookAverageMonthlyRating, BookBase, BookRatings, PaginatedBookList
 from ..Config import Config
-from .utils import filter_title, get_book_reviews_pipeline, get_books, get_top_book_pipeline, get_book_month_average_pipeline
+from ..catalog import catalog
+from ..metrics import stage
+from .utils import aggregate, consume_exception, decode_reviews_cursor, encode_reviews_cursor, get_book_data, get_book_reviews_query, get_book_pages, get_books_by_ids, get_books_summary_pipeline, get_search_meta, get_search_window, prefetch_search_window, get_top_books_query, get_book_monthly_average_query, TitleMatcher
+from .reviews import ReviewBufferStopped, repair_book_stats, review_buffer
+from .stats import update_book_stats
 from math import ceil
 
 
-async def get_book_info(bookId: int, mongoSession: MotorClientSession, aiohttpSession: aiohttp.ClientSession) -> Book:
+async def get_latest_reviews(db, bookId: int, limit: int, mongoSession: MotorClientSession) -> List[str]:
+    """
+    Returns the texts of the latest reviews of a book
+    """
+    with stage("mongo.find"):
+        return [review["review"] async for review in db.reviews.find(
+            **get_book_reviews_query(bookId=bookId, limit=limit, withText=True), projection={"review": 1}, session=mongoSession)]
+
+
+async def get_book_review_summary(db, bookId: int, mongoSession: MotorClientSession, stats: Optional[dict] = None) -> dict:
+    """
+    Returns the rating summary and the latest reviews of a book, empty if it has no reviews.
+    The bookStats document of the book is read, unless it is given.
+    """
+    if stats is None:
+        with stage("mongo.find"):
+            stats = await db.bookStats.find_one({"_id": bookId}, session=mongoSession)
+    if not stats:
+        return {}
+    return {
+        "rating": stats["rating"],
+        "reviewCount": stats["count"],
+        "reviews": await get_latest_reviews(db=db, bookId=bookId, limit=Config.BOOK_REVIEWS_LIMIT, mongoSession=mongoSession)
+    }
+
+
+async def get_book_review_version(bookId: int, mongoSession: MotorClientSession) -> dict:
+    """
+    Returns the rating summary of a book, empty if it has no reviews. Its review count and
+    updatedAt, the server time of its last update, change with every new review, so they
+    version everything derived from the reviews. It can be passed on to get_book_info.
+    """
+    db = mongoSession.client.get_default_database()
+    with stage("mongo.find"):
+        stats = await db.bookStats.find_one(
+            {"_id": bookId}, projection={"count": 1, "rating": 1, "updatedAt": 1}, session=mongoSession)
+    return stats or {}
+
+
+async def get_book_info(bookId: int, mongoSession: MotorClientSession, aiohttpSession: aiohttp.ClientSession, stats: Optional[dict] = None) -> Union[Book, BookRatings]:
     """
     Collects the book info from Gutendex and enriches it with review information from mongo.
+    Only the latest BOOK_REVIEWS_LIMIT reviews are included, the rest are available
+    through the paginated reviews of the book. The rating summary of the book is read
+    unless it is given, e.g. from get_book_review_version.
+    Mongo and Gutendex are queried concurrently. If GUTENDEX_DEADLINE is set and Gutendex
+    has not answered by then, the ratings are returned without the book info, while the
+    Gutendex request completes in the background and fills the book cache.
     """
+    started = asyncio.get_event_loop().time()
     db = mongoSession.client.get_default_database()
-    collection = db.reviews
-    review_obj = {}
-    # Collect the reviews for the specific bookId in mongo
-    async for agg in collection.aggregate(get_book_reviews_pipeline(
-            bookId=bookId), session=mongoSession):
-        review_obj = agg
-    # Get the book info from gutendex
+    # Get the book info from gutendex, while the reviews are collected
+    gutendex = asyncio.ensure_future(get_book_data(
+        bookId=bookId, aiohttpSession=aiohttpSession))
+    gutendex.add_done_callback(consume_exception)
     try:
-        async with aiohttpSession.get("{}/{}".format(Config.GUTENDEX_URL, bookId)) as res:
-            if res.status != 200:
-                d = await res.json()
-                raise Exception(d["detail"])
-            book_data = await res.json()
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail="Could not fetch data from Gutendex: {}".format(e))
+        # Collect the rating summary and the latest reviews for the specific bookId in mongo
+        review_obj = await get_book_review_summary(db=db, bookId=bookId, mongoSession=mongoSession, stats=stats)
+    except Exception:
+        gutendex.cancel()
+        raise
+    if Config.GUTENDEX_DEADLINE is None:
+        book_data = await gutendex
+    else:
+        remaining = Config.GUTENDEX_DEADLINE - \
+            (asyncio.get_event_loop().time() - started)
+        try:
+            # Shielded, so that the request is not cancelled on timeout
+            book_data = await asyncio.wait_for(asyncio.shield(gutendex), timeout=max(remaining, 0))
+        except asyncio.TimeoutError:
+            return BookRatings(id=bookId, **review_obj)
     return Book(**review_obj, **book_data)
 
 
-async def get_book_monthly_average_ratings(bookId: int, mongoSession: MotorClientSession) -> BookAverageMonthlyRating:
+def parse_ids(ids: str) -> List[int]:
+    """
+    Parses a comma separated list of book ids, without duplicates
+    """
+    try:
+        bookIds = list(dict.fromkeys(int(id) for id in ids.split(",") if id.strip()))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="ids should be a comma separated list of book ids")
+    if not bookIds or len(bookIds) > Config.BOOKS_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400, detail="Between 1 and {} ids should be given".format(Config.BOOKS_BATCH_MAX_SIZE))
+    return bookIds
+
+
+async def get_books_info(ids: str, mongoSession: MotorClientSession, aiohttpSession: aiohttp.ClientSession) -> List[Book]:
     """
-    Computes the monthly average ratings of a book in the mongo db
+    Collects the info of many books at once, in the order of the given ids.
+    The rating summaries and latest reviews come from one aggregation and the book info
+    from batched gutendex `ids` requests. Ids that gutendex does not know are left out.
     """
+    bookIds = parse_ids(ids)
+    db = mongoSession.client.get_default_database()
+    summaries = {}
+    with stage("mongo.aggregate"):
+        aggs = await aggregate(db.bookStats, get_books_summary_pipeline(
+            bookIds=bookIds, reviewsLimit=Config.BOOK_REVIEWS_LIMIT), session=mongoSession)
+    for agg in aggs:
+        summaries[agg.pop("bookId")] = agg
+    books_data = await get_books_by_ids(ids=bookIds, aiohttpSession=aiohttpSession)
+    return [Book(**summaries.get(bookId, {}), **books_data[bookId]) for bookId in bookIds if bookId in books_data]
+
+
+async def get_book_reviews(bookId: int, limit: int, cursor: Optional[str], mongoSession: MotorClientSession) -> PaginatedReviewList:
+    """
+    Returns a page of the reviews of a book, latest first.
+    The next page is requested with the nextCursor of the page.
+    """
+    if limit <= 0 or limit > Config.REVIEWS_PAGE_MAX_SIZE:
+        raise HTTPException(
+            status_code=400, detail="Limit should be between 1 and {}".format(Config.REVIEWS_PAGE_MAX_SIZE))
+    after = decode_reviews_cursor(cursor) if cursor is not None else None
+    db = mongoSession.client.get_default_database()
+    with stage("mongo.find"):
+        stats = await db.bookStats.find_one({"_id": bookId}, session=mongoSession)
+        # Fetch one more review to know if there is a next page
+        reviews = [review async for review in db.reviews.find(
+            **get_book_reviews_query(bookId=bookId, limit=limit + 1, after=after), session=mongoSession)]
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        next_cursor = encode_reviews_cursor(
+            reviews[-1]["createdAt"], reviews[-1]["_id"])
+    return PaginatedReviewList(
+        bookId=bookId,
+        totalCount=stats["count"] if stats is not None else 0,
+        reviews=[BookReview(**review) for review in reviews],
+        nextCursor=next_cursor
+    )
+
+
+def parse_period(value: Optional[str], name: str) -> Optional[int]:
+    """
+    Parses a YYYY-MM month to the period (year * 100 + month) used by the monthly rollups
+    """
+    if value is None:
+        return None
+    try:
+        date = datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="{} should be a month in the YYYY-MM format".format(name))
+    return date.year * 100 + date.month
+
+
+async def get_book_monthly_average_ratings(bookId: int, mongoSession: MotorClientSession, fromMonth: Optional[str] = None, toMonth: Optional[str] = None) -> BookAverageMonthlyRating:
+    """
+    Returns the monthly average ratings of a book, optionally from and to a month (YYYY-MM).
+    They are read from the monthly rollups that are updated when a review is added.
+    """
+    fromPeriod = parse_period(fromMonth, "from")
+    toPeriod = parse_period(toMonth, "to")
     db = mongoSession.client.get_default_database()
-    collection = db.reviews
     monthly_averages = []
-    # Collect the monthly average rating for the specific bookId in mongo
-    async for agg in collection.aggregate(get_book_month_average_pipeline(
-            bookId=bookId), session=mongoSession):
-        monthly_averages.append(AverageMonthlyRating(**agg))
+    with stage("mongo.find"):
+        async for rollup in db.bookMonthlyStats.find(**get_book_monthly_average_query(
+                bookId=bookId, fromPeriod=fromPeriod, toPeriod=toPeriod), session=mongoSession):
+            monthly_averages.append(AverageMonthlyRating(
+                month=rollup["month"], year=rollup["year"], rating=rollup["sum"] / rollup["count"]))
     return BookAverageMonthlyRating(bookId=bookId, monthlyAverages=monthly_averages)
 
 
 async def get_top_books_by_rating(amount: int, mongoSession: MotorClientSession, aiohttpSession: aiohttp.ClientSession) -> List[Book]:
     """
     Computes the top n books based on rating and collects the book info from Gutendex.
+    The ratings are read from the precomputed book summaries, sorted by the rating index,
+    the latest reviews of all the top books come from one aggregation and the book info
+    is fetched with batched, concurrent gutendex requests.
     """
     db = mongoSession.client.get_default_database()
-    collection = db.reviews
+    # Collect the rating summaries of the top books in mongo
+    with stage("mongo.find"):
+        top_stats = [stats async for stats in db.bookStats.find(
+            **get_top_books_query(amount=amount), session=mongoSession)]
+    if not top_stats:
+        return []
+    bookIds = [stats["bookId"] for stats in top_stats]
+    # Collect the latest reviews of all the top books with one aggregation
+    with stage("mongo.aggregate"):
+        aggs = await aggregate(db.bookStats, get_books_summary_pipeline(
+            bookIds=bookIds, reviewsLimit=Config.BOOK_REVIEWS_LIMIT), session=mongoSession)
+    reviews = {agg["bookId"]: agg.get("reviews", []) for agg in aggs}
+    # Get the book info from gutendex
+    books_data = await get_books_by_ids(ids=bookIds, aiohttpSession=aiohttpSession)
     result = []
-    # Collect the reviews for the top books in mongo
-    async for agg in collection.aggregate(get_top_book_pipeline(
-            amount=amount), session=mongoSession):
-        # Get the book info from gutendex
-        try:
-            async with aiohttpSession.get("{}/{}".format(Config.GUTENDEX_URL, agg["bookId"])) as res:
-                if res.status != 200:
-                    d = await res.json()
-                    raise Exception(d["detail"])
-                book_data = await res.json()
-                result.append(Book(**agg, **book_data))
-        except Exception as e:
+    for stats in top_stats:  # Keep the order of the ratings
+        if stats["bookId"] not in books_data:
             raise HTTPException(
-                status_code=500, detail="Could not fetch data from Gutendex: {}".format(e))
+                status_code=500, detail="Could not fetch data from Gutendex: Book {} not found.".format(stats["bookId"]))
+        result.append(Book(rating=stats["rating"], reviewCount=stats["count"],
+                           reviews=reviews.get(stats["bookId"], []), **books_data[stats["bookId"]]))
     return result
 
 
 async def add_review(bookId: int, review: ReviewCreate, mongoSession: MotorClientSession):
     """
-    Inserts a review to the mongo databae
+    Inserts a review to the mongo databae and adds it to the rating summary of the book.
+    If the rating summary cannot be updated, the review is undone and an error is returned.
+    With REVIEW_WRITE_BEHIND, the review is queued and inserted in a batch later.
     """
     db = mongoSession.client.get_default_database()
     collection = db.reviews
     try:
         review_obj = Review(**review.dict(), bookId=bookId)
-        await collection.insert_one(review_obj.dict(), session=mongoSession)
+        if Config.REVIEW_WRITE_BEHIND:
+            review_buffer.put(review_obj.dict())
+            return "ok"
+        review_doc = review_obj.dict()
+        with stage("mongo.insert_one"):
+            await collection.insert_one(review_doc, session=mongoSession)
+        try:
+            with stage("mongo.update_stats"):
+                await update_book_stats(db=db, reviews=[review_doc], session=mongoSession)
+        except Exception:
+            await repair_book_stats(db=db, reviews=[review_doc], session=mongoSession)
+            raise
         return "ok"
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=503, detail="Too many reviews, try again later")
+    except ReviewBufferStopped:
+        raise HTTPException(
+            status_code=503, detail="The api is shutting down, try again later")
     except Exception as e:
         raise HTTPException(status_code=500, detail="Could not add review")
 
@@ -91,45 +252,112 @@ async def get_books_by_title(title: str, aiohttpSession: aiohttp.ClientSession)
     """
     Searches the books from Gutendex based on title.
     """
-    next = "{}/?search={}".format(Config.GUTENDEX_URL, title)
-    result = []
-    while next is not None:  # Need to get all the books based on gutendex pagination
-        books, next = await get_books(url=next, aiohttpSession=aiohttpSession)
-        result += [BookBase(**book_data) for book_data in books if filter_title(
-            title=book_data["title"], search_string=title)]
-    return result
+    books = await get_books_by_title_stream(title=title, aiohttpSession=aiohttpSession)
+    return [book async for book in books]
+
+
+async def get_books_by_title_stream(title: str, aiohttpSession: aiohttp.ClientSession) -> AsyncIterator[BookBase]:
+    """
+    Searches the books from Gutendex based on title, but returns an async generator
+    that yields the matching books as soon as each gutendex page arrives.
+    The first page is fetched eagerly, so that a gutendex error can still be
+    returned as an error response before anything is streamed.
+    """
+    if Config.LOCAL_CATALOG:
+        return await get_catalog_books_by_title_stream(title=title)
+    url = "{}/?search={}".format(Config.GUTENDEX_URL, title)
+    # Need to get all the books based on gutendex pagination
+    pages = get_book_pages(url=url, aiohttpSession=aiohttpSession)
+    first_page = await pages.__anext__()
+    matcher = TitleMatcher(title)
+
+    async def books() -> AsyncIterator[BookBase]:
+        page = first_page
+        try:
+            while True:
+                for book_data in matcher.filter(page):
+                    yield BookBase(**book_data)
+                page = await pages.__anext__()
+        except StopAsyncIteration:
+            pass
+        finally:
+            await pages.aclose()
+
+    return books()
 
 
-async def get_books_by_title_paginated(title: str, page: int, aiohttpSession: aiohttp.ClientSession) -> PaginatedBookList:
+async def get_books_by_title_paginated(title: str, page: int, aiohttpSession: aiohttp.ClientSession, pageSize: Optional[int] = None) -> PaginatedBookList:
     """
     Searches the books from Gutendex based on title, but uses the pagination.
     For simplicity and to make a paginated solution fast I do not filter on
     the results titles, because, it would mess up with the results take from
     gutendex.
+    The count and the page size of the search are taken from its first gutendex page,
+    so the total pages are exact. With a pageSize, the pages are assembled from the
+    gutendex pages, and the gutendex pages of the next page are fetched in the background.
     """
     if page <= 0:
         raise HTTPException(
             status_code=400, detail="Page index should be greater than 0")
-    try:
-        async with aiohttpSession.get(Config.GUTENDEX_URL, params={"page": page, "search": title}) as res:
-            if res.status != 200:
-                d = await res.json()
-                raise Exception(d["detail"])
-            data = await res.json()
-    except Exception as e:
+    if pageSize is not None and not 0 < pageSize <= Config.SEARCH_PAGE_MAX_SIZE:
+        raise HTTPException(
+            status_code=400, detail="Page size should be between 1 and {}".format(Config.SEARCH_PAGE_MAX_SIZE))
+    if Config.LOCAL_CATALOG:
+        return await get_catalog_books_by_title_paginated(title=title, page=page, pageSize=pageSize)
+    meta = await get_search_meta(search=title, aiohttpSession=aiohttpSession)
+    page_size = pageSize or meta["pageSize"]
+    total_pages = ceil(meta["count"] / page_size)
+    if page > max(total_pages, 1):
         raise HTTPException(
-            status_code=500, detail="Could not fetch data from Gutendex: {}".format(e))
+            status_code=400, detail="Page index should be at most {}".format(total_pages))
+    start = (page - 1) * page_size
+    books = await get_search_window(search=title, start=start, end=min(start + page_size, meta["count"]),
+                                    meta=meta, aiohttpSession=aiohttpSession)
+    if Config.SEARCH_PREFETCH and page < total_pages:
+        prefetch_search_window(search=title, start=start + page_size, end=min(start + 2 * page_size, meta["count"]),
+                               meta=meta, aiohttpSession=aiohttpSession)
+    return PaginatedBookList(
+        totalCount=meta["count"],
+        page=page,
+        nextPage=page + 1 if page < total_pages else None,
+        previousPage=page - 1 if page > 1 else None,
+        totalPages=total_pages,
+        books=[BookBase(**book) for book in books]
+    )
+
 
-    next_page = page + 1 if data["next"] is not None else None
-    prev_page = page - 1 if data["previous"] is not None else None
-    # In the last page the results might be fewer than normally, so that could lead to miscalculation
-    total_pages = page if next_page is None else ceil(
-        data["count"] / len(data["results"]))
+async def get_catalog_books_by_title_stream(title: str) -> AsyncIterator[BookBase]:
+    """
+    Searches the books of the local catalog based on title only,
+    returns an async generator of the books, most downloaded first.
+    """
+    ids = await catalog.search(title)
+
+    async def books() -> AsyncIterator[BookBase]:
+        for i in range(0, len(ids), Config.CATALOG_PAGE_SIZE):
+            for book in await catalog.get_books(ids[i:i + Config.CATALOG_PAGE_SIZE]):
+                yield BookBase(**book)
+
+    return books()
+
+
+async def get_catalog_books_by_title_paginated(title: str, page: int, pageSize: Optional[int] = None) -> PaginatedBookList:
+    """
+    Searches the books of the local catalog based on title only, using the pagination.
+    Unlike gutendex the titles are filtered before paginating, so the pages and the counts are exact.
+    """
+    ids = await catalog.search(title)
+    page_size = pageSize or Config.CATALOG_PAGE_SIZE
+    total_pages = ceil(len(ids) / page_size)
+    if page > max(total_pages, 1):
+        raise HTTPException(
+            status_code=400, detail="Page index should be at most {}".format(total_pages))
+    books = await catalog.get_books(ids[(page - 1) * page_size:page * page_size])
     return PaginatedBookList(
-        totalCount=data["count"],
+        totalCount=len(ids),
         page=page,
-        nextPage=next_page,
-        previousPage=prev_page,
+        nextPage=page + 1 if page < total_pages else None,
+        previousPage=page - 1 if page > 1 else None,
         totalPages=total_pages,
-        books=[BookBase(**book) for book in data["results"]]
+        books=[BookBase(**book) for book in books]
     )
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List, Tuple, Union
+from motor.motor_tornado import MotorClientSession
+from fastapi import HTTPException
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from ..Config import Config
+from ..clients import mongo_registry
+from ..schemas.review import BulkReviewError, BulkReviewResult, Review
+from .stats import recompute_book_stats, update_book_stats
+
+logger = logging.getLogger(__name__)
+
+
+async def repair_book_stats(db, reviews: List[dict], session=None, undo: bool = True):
+    """
+    Recomputes the rating summaries of the books of a batch of reviews whose summaries could not be
+    updated, which might have been updated halfway. With undo the reviews are removed first, so that
+    the reviews the client gets an error for are neither stored nor counted, and a retry of the
+    client is not counted twice. Without undo the reviews are kept and counted.
+    """
+    bookIds = sorted({review["bookId"] for review in reviews})
+    try:
+        if undo:
+            await db.reviews.delete_many({"_id": {"$in": [
+                review["_id"] for review in reviews if "_id" in review]}}, session=session)
+        for bookId in bookIds:
+            await recompute_book_stats(db=db, bookId=bookId, session=session)
+    except Exception:
+        logger.exception("Could not repair the rating summaries of the books %s, run rebuild-stats", bookIds)
+
+
+async def insert_reviews(db, reviews: List[dict], session=None, undo: bool = True) -> List[Tuple[int, str]]:
+    """
+    Inserts a batch of validated reviews with one unordered insert_many, and adds the
+    inserted ones to the rating summaries. Returns the position in the batch and the
+    error of every review that could not be inserted.
+    If the insert or the rating summaries fail, the summaries of the books are repaired
+    (see repair_book_stats, with undo the reviews of the batch are removed) and the error is raised.
+    """
+    failed = []
+    try:
+        await db.reviews.insert_many(reviews, ordered=False, session=session)
+    except BulkWriteError as e:
+        failed = [(error["index"], error["errmsg"])
+                  for error in e.details["writeErrors"]]
+    except Exception:
+        # Some of the reviews might have been inserted, insert_many sets their _id beforehand
+        await repair_book_stats(db=db, reviews=reviews, session=session, undo=undo)
+        raise
+    failed_positions = {position for position, _ in failed}
+    inserted = [review for position, review in enumerate(reviews) if position not in failed_positions]
+    try:
+        await update_book_stats(db=db, reviews=inserted, session=session)
+    except Exception:
+        await repair_book_stats(db=db, reviews=inserted, session=session, undo=undo)
+        raise
+    return failed
+
+
+def validation_error_detail(e: ValidationError) -> str:
+    return "; ".join("{}: {}".format(".".join(str(loc) for loc in error["loc"]), error["msg"]) for error in e.errors())
+
+
+async def add_reviews(reviews: AsyncIterator[Union[str, dict]], mongoSession: MotorClientSession) -> BulkReviewResult:
+    """
+    Validates and inserts many reviews, each one either a json string or an already parsed object.
+    The reviews are consumed as they arrive and inserted in batches of BULK_REVIEWS_BATCH_SIZE,
+    so the whole import is never held in memory. The invalid and the failed reviews are
+    reported by their index in the input. If a batch fails, it is undone and an error is returned,
+    the batches before it stay inserted.
+    """
+    db = mongoSession.client.get_default_database()
+    inserted = 0
+    errors = []
+    batch = []
+    batch_indexes = []
+
+    async def flush():
+        nonlocal inserted
+        try:
+            failed = await insert_reviews(db=db, reviews=batch, session=mongoSession)
+        except Exception:
+            logger.exception("Could not insert %d reviews", len(batch))
+            raise HTTPException(status_code=500, detail="Could not add the reviews from index {}, "
+                                "the {} reviews before it were added".format(batch_indexes[0], inserted))
+        inserted += len(batch) - len(failed)
+        errors.extend(BulkReviewError(index=batch_indexes[position], detail=detail)
+                      for position, detail in failed)
+        batch.clear()
+        batch_indexes.clear()
+
+    index = 0
+    async for item in reviews:
+        try:
+            review = Review.parse_raw(item) if isinstance(
+                item, (str, bytes)) else Review.parse_obj(item)
+            batch.append(review.dict())
+            batch_indexes.append(index)
+        except ValidationError as e:
+            errors.append(BulkReviewError(
+                index=index, detail=validation_error_detail(e)))
+        index += 1
+        if len(batch) >= Config.BULK_REVIEWS_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    errors.sort(key=lambda error: error.index)
+    return BulkReviewResult(inserted=inserted, errors=errors)
+
+
+class ReviewBufferStopped(Exception):
+    """
+    The write-behind buffer was stopped, e.g. because the api is shutting down
+    """
+
+
+class ReviewWriteBuffer(object):
+    """
+    Write-behind buffer of reviews. The reviews are acknowledged as soon as they are queued,
+    and a background task inserts them in batches, when batch_size reviews are queued or
+    every flush_interval seconds, in the order they were queued. The queue is bounded, put raises
+    asyncio.QueueFull when it is full, and ReviewBufferStopped once the buffer is stopped.
+    Since the reviews are acknowledged before they are written, a failed batch is logged, and
+    if its rating summaries fail to update they are recomputed for its books, keeping its reviews.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float, write_concern: WriteConcern = None):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_concern = write_concern
+        self._queue = None
+        self._full = None
+        self._task = None
+        self._flushing = None
+        # The reviews already taken from the queue for the next batch
+        self._batch = []
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts the background task, it has to be called from inside the running event loop.
+        A stopped buffer accepts reviews again once it is started.
+        """
+        self._stopped = False
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._full = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def put(self, review: dict):
+        if self._stopped:
+            raise ReviewBufferStopped("The review buffer is stopped")
+        self.start()
+        self._queue.put_nowait(review)
+        if self.qsize() >= self.batch_size:
+            self._full.set()
+
+    def qsize(self) -> int:
+        return self._queue.qsize() + len(self._batch) if self._queue is not None else 0
+
+    def _take_batch(self) -> List[dict]:
+        """
+        Takes the next batch, starting with the reviews already taken for it, so the order is kept
+        """
+        batch, self._batch = self._batch, []
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if self.qsize() < self.batch_size:
+            self._full.clear()
+        return batch
+
+    async def _flush(self, batch: List[dict]):
+        db = mongo_registry.client.get_default_database(
+            write_concern=self.write_concern)
+        try:
+            # The reviews were acknowledged already, so they are kept and their books recomputed
+            failed = await insert_reviews(db=db, reviews=batch, undo=False)
+            for _, detail in failed:
+                logger.error("Could not insert buffered review: %s", detail)
+        except Exception:
+            logger.exception(
+                "Could not insert %d buffered reviews, the rating summaries of their books were recomputed", len(batch))
+
+    async def _run(self):
+        # Also checked on every batch, since wait_for can swallow the cancellation of stop
+        while not self._stopped:
+            # Wait for the first review, then for a full batch or the flush interval.
+            # The review is kept for the batch, so a stop while waiting writes it first
+            self._batch.append(await self._queue.get())
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flushing = asyncio.ensure_future(
+                self._flush(self._take_batch()))
+            # Stopping should not interrupt a batch that is being written
+            await asyncio.shield(self._flushing)
+
+    async def stop(self):
+        """
+        Stops the background task and writes all the queued reviews.
+        From then on the buffer rejects new reviews, until it is started again.
+        """
+        self._stopped = True
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if self._flushing is not None:
+            await self._flushing
+        while self.qsize() > 0:
+            await self._flush(self._take_batch())
+        self._task = None
+        self._flushing = None
+
+
+def parse_write_concern(w: str) -> WriteConcern:
+    return WriteConcern(w=int(w) if w.isdigit() else w)
+
+
+review_buffer = ReviewWriteBuffer(
+    max_size=Config.REVIEW_BUFFER_MAX_SIZE,
+    batch_size=Config.REVIEW_BUFFER_BATCH_SIZE,
+    flush_interval=Config.REVIEW_BUFFER_FLUSH_INTERVAL_MS / 1000,
+    write_concern=parse_write_concern(Config.REVIEW_BUFFER_WRITE_CONCERN))
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+from typing import AsyncIterator, List
+from pymongo import ReplaceOne, UpdateOne
+from .utils import aggregate, get_book_monthly_stats_pipeline, get_book_stats_pipeline, get_book_stats_update, iter_aggregate
+
+
+def review_period(createdAt: datetime):
+    """
+    Returns the year and month of a review, in UTC like mongo's $year and $month
+    """
+    if createdAt.tzinfo is not None:
+        createdAt = createdAt.astimezone(timezone.utc)
+    return createdAt.year, createdAt.month
+
+
+async def update_book_stats(db, reviews: List[dict], session=None):
+    """
+    Adds a batch of inserted reviews to the rating summaries of their books (bookStats collection)
+    and to the monthly rating rollups of their books (bookMonthlyStats collection).
+    Every document is updated atomically, so concurrent inserts do not lose updates.
+    """
+    batches = {}
+    monthly_batches = {}
+    for review in reviews:
+        batch = batches.setdefault(review["bookId"], {
+            "count": 0, "total": 0, "lastReviewAt": review["createdAt"]})
+        batch["count"] += 1
+        batch["total"] += review["rating"]
+        batch["lastReviewAt"] = max(batch["lastReviewAt"], review["createdAt"])
+        year, month = review_period(review["createdAt"])
+        monthly_batch = monthly_batches.setdefault(
+            (review["bookId"], year, month), {"count": 0, "sum": 0})
+        monthly_batch["count"] += 1
+        monthly_batch["sum"] += review["rating"]
+    if not batches:
+        return
+    await db.bookStats.bulk_write([
+        UpdateOne({"_id": bookId}, get_book_stats_update(bookId=bookId, **batch), upsert=True)
+        for bookId, batch in batches.items()
+    ], ordered=False, session=session)
+    await db.bookMonthlyStats.bulk_write([
+        UpdateOne({"_id": {"bookId": bookId, "year": year, "month": month}}, {
+            "$inc": monthly_batch,
+            "$setOnInsert": {"bookId": bookId, "year": year, "month": month, "period": year * 100 + month}
+        }, upsert=True)
+        for (bookId, year, month), monthly_batch in monthly_batches.items()
+    ], ordered=False, session=session)
+
+
+async def recompute_book_stats(db, bookId: int, session=None):
+    """
+    Recomputes the rating summary and the monthly rating rollups of one book from its reviews.
+    Unlike update_book_stats it is idempotent, so it repairs the summaries of a book after
+    an update that failed halfway.
+    """
+    match = [{"$match": {"bookId": bookId}}]
+    stats = await aggregate(db.reviews, match + get_book_stats_pipeline(), session=session)
+    if stats:
+        await db.bookStats.replace_one({"_id": bookId}, stats[0], upsert=True, session=session)
+    else:
+        await db.bookStats.delete_one({"_id": bookId}, session=session)
+    rollups = await aggregate(db.reviews, match + get_book_monthly_stats_pipeline(), session=session)
+    if rollups:
+        await db.bookMonthlyStats.bulk_write([
+            ReplaceOne({"_id": rollup["_id"]}, rollup, upsert=True) for rollup in rollups
+        ], ordered=False, session=session)
+    await db.bookMonthlyStats.delete_many(
+        {"bookId": bookId, "_id": {"$nin": [rollup["_id"] for rollup in rollups]}}, session=session)
+
+
+async def replace_all(collection, docs: AsyncIterator[dict], session=None, batch_size: int = 1000) -> int:
+    """
+    Replaces the documents of a collection with the given ones (by _id), in batches,
+    and removes the documents that were not given.
+    Returns the amount of documents written.
+    """
+    rebuilt_at = datetime.now()
+    count = 0
+    batch = []
+    async for doc in docs:
+        doc["rebuiltAt"] = rebuilt_at
+        batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+        if len(batch) >= batch_size:
+            await collection.bulk_write(batch, ordered=False, session=session)
+            count += len(batch)
+            batch = []
+    if batch:
+        await collection.bulk_write(batch, ordered=False, session=session)
+        count += len(batch)
+    await collection.delete_many({"rebuiltAt": {"$ne": rebuilt_at}}, session=session)
+    return count
+
+
+async def rebuild_book_stats(db, session=None, batch_size: int = 1000) -> int:
+    """
+    Recomputes the rating summaries and the monthly rating rollups of all the books
+    from the reviews collection, e.g. to backfill them for existing reviews.
+    Reviews added while it runs might be counted twice, so it should run while no reviews are added.
+    Returns the amount of books summarized.
+    """
+    count = await replace_all(db.bookStats, iter_aggregate(
+        db.reviews, get_book_stats_pipeline(), session=session, allowDiskUse=True), session=session, batch_size=batch_size)
+    await replace_all(db.bookMonthlyStats, iter_aggregate(
+        db.reviews, get_book_monthly_stats_pipeline(), session=session, allowDiskUse=True), session=session, batch_size=batch_size)
+    return count
@@ -1,86 +1,226 @@
+import asyncio
+import time
+import unicodedata
+from collections import deque
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 import aiohttp
+from bson import ObjectId
+from datetime import datetime
 from fastapi import HTTPException
+from math import ceil
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from yarl import URL
+from ..Config import Config
+from ..cache import SearchCache, SingleFlight, book_cache, search_cache
+from ..gutendex import GutendexError, GutendexUnavailable, gutendex_client
+from ..profiling import check_slow_aggregation
 
 
-def get_book_reviews_pipeline(bookId: int):
+async def iter_aggregate(collection, pipeline: List[dict], session=None, **kwargs) -> AsyncIterator[dict]:
+    """
+    Runs an aggregation and yields its documents as the cursor returns them.
+    The aggregations slower than SLOW_QUERY_MS are logged with their explain output,
+    counting only the time waiting for the cursor and not the time the consumer takes.
+    """
+    cursor = collection.aggregate(pipeline, session=session, **kwargs)
+    duration = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            doc = await cursor.__anext__()
+        except StopAsyncIteration:
+            break
+        finally:
+            duration += time.perf_counter() - started
+        yield doc
+    check_slow_aggregation(collection, pipeline, duration)
+
+
+async def aggregate(collection, pipeline: List[dict], session=None, **kwargs) -> List[dict]:
+    """
+    Runs an aggregation and returns its documents.
+    The aggregations slower than SLOW_QUERY_MS are logged with their explain output.
+    """
+    return [doc async for doc in iter_aggregate(collection, pipeline, session=session, **kwargs)]
+
+
+def get_book_reviews_query(bookId: int, limit: int, after: Optional[Tuple[datetime, ObjectId]] = None, withText: bool = False):
+    """
+    Returns the find arguments that are used on the reviews collection to get
+    the latest reviews of a book. Pages are taken with keyset pagination, after
+    the (createdAt, _id) of the last review of the previous page, so every page
+    is a bounded scan of the bookId_createdAt_id index.
+    With withText, the ratings without a review text are skipped before the limit.
+    """
+    filter = {"bookId": bookId}
+    if withText:
+        filter["review"] = {"$ne": None}
+    if after is not None:
+        createdAt, id = after
+        filter["$or"] = [
+            {"createdAt": {"$lt": createdAt}},
+            {"createdAt": createdAt, "_id": {"$lt": id}}
+        ]
+    return {
+        "filter": filter,
+        "sort": [("createdAt", -1), ("_id", -1)],
+        "limit": limit
+    }
+
+
+def encode_reviews_cursor(createdAt: datetime, id: ObjectId) -> str:
+    """
+    Returns the opaque cursor of the reviews page that starts after the given review
+    """
+    return urlsafe_b64encode("{}|{}".format(createdAt.isoformat(), id).encode()).decode()
+
+
+def decode_reviews_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """
+    Returns the (createdAt, _id) of the review a cursor points after
+    """
+    try:
+        createdAt, id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(createdAt), ObjectId(id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_book_monthly_stats_pipeline():
     """
     Returns the pipeline object that is used for the aggregation
-    to get the reviews and average rating of a book,
+    to compute the monthly rating rollups of every book from its reviews
     """
     return [
         {
-            "$match": {"bookId": bookId}
-        }, {
             "$group": {
-                "_id": "$bookId",
-                "rating": {"$avg": "$rating"},
-                "reviews": {"$push": "$review"}
+                "_id": {"bookId": "$bookId", "year": {"$year": "$createdAt"}, "month": {"$month": "$createdAt"}},
+                "count": {"$sum": 1},
+                "sum": {"$sum": "$rating"}
             }
         }, {
             "$project": {
-                "bookId": "$_id",
-                "rating": 1,
-                "reviews": 1,
-                "_id": 0
+                "_id": 1,
+                "bookId": "$_id.bookId",
+                "year": "$_id.year",
+                "month": "$_id.month",
+                "period": {"$add": [{"$multiply": ["$_id.year", 100]}, "$_id.month"]},
+                "count": 1,
+                "sum": 1
             }
         }
     ]
 
 
-def get_book_month_average_pipeline(bookId: int):
+def get_book_monthly_average_query(bookId: int, fromPeriod: Optional[int] = None, toPeriod: Optional[int] = None):
     """
-    Returns the pipeline object that is used for the aggregation
-    to get average rating of a book per month
+    Returns the find arguments that are used on the bookMonthlyStats collection
+    to get the monthly rollups of a book, optionally between two periods (year * 100 + month)
+    """
+    filter = {"bookId": bookId}
+    if fromPeriod is not None or toPeriod is not None:
+        filter["period"] = {}
+        if fromPeriod is not None:
+            filter["period"]["$gte"] = fromPeriod
+        if toPeriod is not None:
+            filter["period"]["$lte"] = toPeriod
+    return {
+        "filter": filter,
+        "sort": [("period", -1)]
+    }
+
+
+def get_top_books_query(amount: int):
+    """
+    Returns the find arguments that are used on the bookStats collection
+    to get the top rated books, it is an indexed sorted read
+    """
+    return {
+        "filter": {},
+        "sort": [("rating", -1), ("bookId", 1)],
+        "limit": amount
+    }
+
+
+def get_books_summary_pipeline(bookIds: List[int], reviewsLimit: int):
+    """
+    Returns the pipeline object that is used for the aggregation on the bookStats
+    collection to get the rating summary and the latest review texts of many books at once
     """
     return [
         {
-            "$match": {"bookId": bookId}
+            "$match": {"bookId": {"$in": bookIds}}
         }, {
-            "$group": {
-                "_id": {"month": {"$month": "$createdAt"}, "year": {"$year": "$createdAt"}},
-                "rating": {"$avg": "$rating"}
+            "$lookup": {
+                "from": "reviews",
+                "localField": "bookId",
+                "foreignField": "bookId",
+                "pipeline": [
+                    {"$match": {"review": {"$ne": None}}},
+                    {"$sort": {"createdAt": -1, "_id": -1}},
+                    {"$limit": reviewsLimit},
+                    {"$project": {"review": 1, "_id": 0}}
+                ],
+                "as": "latestReviews"
             }
         }, {
             "$project": {
-                "rating": 1,
                 "_id": 0,
-                "_id": 0,
-                "month": "$_id.month",
-                "year": "$_id.year"
+                "bookId": 1,
+                "rating": 1,
+                "reviewCount": "$count",
+                "reviews": "$latestReviews.review"
             }
-        }, {
-            "$sort": {"year": -1, "month": -1}
         }
     ]
 
 
-def get_top_book_pipeline(amount: int):
+def get_book_stats_pipeline():
     """
     Returns the pipeline object that is used for the aggregation
-    to get the reviews and average rating of a book,
+    to compute the rating summary of every book from its reviews
     """
     return [
         {
             "$group": {
                 "_id": "$bookId",
-                "rating": {"$avg": "$rating"},
-                "reviews": {"$push": "$review"}
-            }
-        },
-        {
-            "$sort": {
-                "rating": -1
+                "count": {"$sum": 1},
+                "sum": {"$sum": "$rating"},
+                "lastReviewAt": {"$max": "$createdAt"}
             }
-        },
-        {
-            "$limit": amount
-        },
-        {
+        }, {
             "$project": {
+                "_id": 1,
                 "bookId": "$_id",
-                "rating": 1,
-                "reviews": 1,
-                "_id": 0
+                "count": 1,
+                "sum": 1,
+                "rating": {"$divide": ["$sum", "$count"]},
+                "lastReviewAt": 1,
+                "updatedAt": "$$NOW"
+            }
+        }
+    ]
+
+
+def get_book_stats_update(bookId: int, count: int, total: float, lastReviewAt: datetime):
+    """
+    Returns the update pipeline that adds new reviews to the rating summary
+    of a book, it recomputes the average in the same atomic update.
+    updatedAt is the server time of the update ($$NOW, like $currentDate in a pipeline),
+    unlike lastReviewAt it also moves for reviews with a past createdAt.
+    """
+    return [
+        {
+            "$set": {
+                "bookId": bookId,
+                "count": {"$add": [{"$ifNull": ["$count", 0]}, count]},
+                "sum": {"$add": [{"$ifNull": ["$sum", 0]}, total]},
+                "lastReviewAt": {"$max": [{"$ifNull": ["$lastReviewAt", lastReviewAt]}, lastReviewAt]},
+                "updatedAt": "$$NOW"
+            }
+        }, {
+            "$set": {
+                "rating": {"$divide": ["$sum", "$count"]}
             }
         }
     ]
@@ -103,18 +243,306 @@ def filter_title(title: str, search_string: str) -> bool:
     return True
 
 
+def normalize_title(text: str) -> str:
+    """
+    Casefolds a text and strips its accents, e.g. "Café" becomes "cafe"
+    """
+    text = text.casefold()
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+class TitleMatcher(object):
+    """
+    Filters titles on the terms of a search string like filter_title, but it is built
+    once per search and ignores the case and the accents, so "cafe" matches "Café".
+    The terms are normalized once, the longest first as they reject more titles,
+    and every title is normalized once for all of them.
+    """
+
+    def __init__(self, search_string: str):
+        self.terms = sorted(set(normalize_title(search_string).split()), key=len, reverse=True)
+
+    def match(self, title: str) -> bool:
+        title = normalize_title(title)
+        for term in self.terms:
+            if term not in title:
+                return False
+        return True
+
+    def filter(self, books: Iterable[dict]) -> List[dict]:
+        """
+        Returns the books of a page whose title matches
+        """
+        terms = self.terms
+        if len(terms) == 1:
+            term = terms[0]
+            return [book for book in books if term in normalize_title(book["title"])]
+        return [book for book in books if self.match(book["title"])]
+
+
+def gutendex_http_error(e: GutendexError) -> HTTPException:
+    return HTTPException(
+        status_code=500, detail="Could not fetch data from Gutendex: {}".format(e.detail))
+
+
+async def fetch_books_page(url, aiohttpSession: aiohttp.ClientSession) -> Tuple[dict, int]:
+    """
+    Fetches a gutendex book list page, returns its data and the size of the response in bytes
+    """
+    try:
+        return await gutendex_client.get_json(url=url, aiohttpSession=aiohttpSession)
+    except GutendexError as e:
+        raise gutendex_http_error(e)
+
+
+def search_cache_key(url) -> Optional[Tuple[str, int]]:
+    """
+    Returns the search cache key of a gutendex url, or None if it is not a search url
+    """
+    query = URL(url).query
+    if "search" not in query:
+        return None
+    return SearchCache.key(search=query["search"], page=int(query.get("page", 1)))
+
+
+async def get_books_page(url, aiohttpSession: aiohttp.ClientSession) -> dict:
+    """
+    Returns the whole response of a gutendex book list page
+    (count, next, previous and results).
+    The search pages go through the search cache, and an expired cached page
+    is served if gutendex is unavailable.
+    """
+    key = search_cache_key(url)
+    if key is None:
+        data, _ = await fetch_books_page(url=url, aiohttpSession=aiohttpSession)
+        return data
+
+    async def fetch():
+        return await gutendex_client.get_json(url=url, aiohttpSession=aiohttpSession)
+    try:
+        return await search_cache.get_or_fetch(key, fetch)
+    except GutendexUnavailable as e:
+        # Served without caching it again, so it is refreshed as soon as gutendex is back
+        stale = search_cache.cache.get_stale(key)
+        if stale is None:
+            raise gutendex_http_error(e)
+        return stale
+    except GutendexError as e:
+        raise gutendex_http_error(e)
+
+
+def consume_exception(task: asyncio.Future):
+    if not task.cancelled():
+        task.exception()
+
+
+def search_page_url(search: str, page: int) -> str:
+    return str(URL(Config.GUTENDEX_URL).with_query(page=page, search=search))
+
+
+async def get_search_meta(search: str, aiohttpSession: aiohttp.ClientSession) -> dict:
+    """
+    Returns the count and the page size of a gutendex search, taken from its first page.
+    They are cached by search, so that the total pages are the same for every page of
+    a search, without depending on the length of the page that was requested.
+    """
+    key, _ = SearchCache.key(search=search, page=1)
+    meta = search_cache.meta.get(key)
+    if meta is None:
+        first = await get_books_page(url=search_page_url(search, 1), aiohttpSession=aiohttpSession)
+        meta = {"count": first["count"], "pageSize": max(len(first["results"]), 1)}
+        search_cache.meta.set(key, meta)
+    return meta
+
+
+def search_window_pages(start: int, end: int, pageSize: int) -> range:
+    """
+    Returns the gutendex pages that hold the results from start up to end (exclusive)
+    """
+    if end <= start:
+        return range(0)
+    return range(start // pageSize + 1, (end - 1) // pageSize + 2)
+
+
+async def get_search_window(search: str, start: int, end: int, meta: dict, aiohttpSession: aiohttp.ClientSession) -> List[dict]:
+    """
+    Returns the results of a gutendex search from start up to end (exclusive),
+    assembled from the gutendex pages that hold them, which are fetched concurrently.
+    """
+    pages = search_window_pages(start=start, end=end, pageSize=meta["pageSize"])
+    if not pages:
+        return []
+    pages_data = await asyncio.gather(*[get_books_page(
+        url=search_page_url(search, page), aiohttpSession=aiohttpSession) for page in pages])
+    results = [book for page_data in pages_data for book in page_data["results"]]
+    offset = start - (pages[0] - 1) * meta["pageSize"]
+    return results[offset:offset + end - start]
+
+
+def prefetch_search_window(search: str, start: int, end: int, meta: dict, aiohttpSession: aiohttp.ClientSession):
+    """
+    Fetches the gutendex pages of a search window in the background, to the search cache
+    """
+    for page in search_window_pages(start=start, end=end, pageSize=meta["pageSize"]):
+        task = asyncio.ensure_future(get_books_page(
+            url=search_page_url(search, page), aiohttpSession=aiohttpSession))
+        task.add_done_callback(consume_exception)
+
+
 async def get_books(url, aiohttpSession: aiohttp.ClientSession):
     """
     Returns the book data and the next url, in order to recursively fetch all
     books at once
     """
+    res_data = await get_books_page(url=url, aiohttpSession=aiohttpSession)
+    return res_data["results"], res_data["next"]
+
+
+async def get_book_pages(url, aiohttpSession: aiohttp.ClientSession, parallel: bool = None) -> AsyncIterator[List[dict]]:
+    """
+    Yields the book data of every page of a gutendex book list, in order.
+    Sequentially it follows the `next` links one by one. In parallel mode
+    the first page tells the total count and the page size, so the urls
+    of the remaining pages are computed and fetched ahead concurrently, while
+    the pages are still yielded in order. At most GUTENDEX_CONCURRENCY pages are
+    fetched ahead, the next one is only requested when a page is yielded, so a
+    slow consumer does not get the whole search buffered in memory.
+    """
+    if parallel is None:
+        parallel = Config.GUTENDEX_PARALLEL_PAGES
+    first = await get_books_page(url=url, aiohttpSession=aiohttpSession)
+    yield first["results"]
+    if first["next"] is None:
+        return
+    if not parallel or not first["results"]:
+        next = first["next"]
+        while next is not None:
+            books, next = await get_books(url=next, aiohttpSession=aiohttpSession)
+            yield books
+        return
+
+    total_pages = ceil(first["count"] / len(first["results"]))
+    pages = iter(range(2, total_pages + 1))
+    tasks = deque()
+
+    def fetch_next_page():
+        for page in pages:  # Takes the next page, if any is left
+            tasks.append(asyncio.ensure_future(get_books(
+                url=str(URL(url).update_query(page=page)), aiohttpSession=aiohttpSession)))
+            break
+
+    for _ in range(max(Config.GUTENDEX_CONCURRENCY, 1)):
+        fetch_next_page()
+    try:
+        while tasks:
+            books, _ = await tasks[0]
+            tasks.popleft()
+            fetch_next_page()
+            yield books
+    finally:  # The consumer might stop early or a page might fail
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                task.exception()  # Mark a failure as retrieved
+            else:
+                task.cancel()
+
+
+book_fetches = SingleFlight()
+
+
+async def fetch_book_data(bookId: int, aiohttpSession: aiohttp.ClientSession) -> dict:
+    """
+    Fetches the gutendex book data of a single book and caches it.
+    Concurrent fetches of the same book share one gutendex request.
+    """
+    async def fetch():
+        book_data, _ = await gutendex_client.get_json(
+            url="{}/{}".format(Config.GUTENDEX_URL, bookId), aiohttpSession=aiohttpSession)
+        await book_cache.set(bookId, book_data)
+        return book_data
+    return await book_fetches.do(bookId, fetch)
+
+
+def revalidate_book_data(bookId: int, aiohttpSession: aiohttp.ClientSession):
+    """
+    Refreshes the cached book data of a book in the background,
+    unless it is already being fetched
+    """
+    async def refresh():
+        try:
+            await fetch_book_data(bookId=bookId, aiohttpSession=aiohttpSession)
+        except GutendexError:
+            pass  # The stale book data is kept until the next refresh
+    book_fetches.start(("revalidate", bookId), refresh)
+
+
+async def get_book_data(bookId: int, aiohttpSession: aiohttp.ClientSession) -> dict:
+    """
+    Returns the gutendex book data of a single book, from the book cache if possible.
+    A book that expired at most BOOK_CACHE_MAX_STALE seconds ago is served right away
+    and refreshed in the background (stale-while-revalidate).
+    An expired cached book is also served if gutendex is unavailable.
+    """
+    book_data = await book_cache.get(bookId)
+    if book_data is not None:
+        return book_data
+    if Config.BOOK_CACHE_MAX_STALE > 0:
+        book_data = book_cache.get_stale(bookId, max_stale=Config.BOOK_CACHE_MAX_STALE)
+        if book_data is not None:
+            revalidate_book_data(bookId=bookId, aiohttpSession=aiohttpSession)
+            return book_data
+    try:
+        return await fetch_book_data(bookId=bookId, aiohttpSession=aiohttpSession)
+    except GutendexUnavailable as e:
+        stale = book_cache.get_stale(bookId)
+        if stale is None:
+            raise gutendex_http_error(e)
+        return stale
+    except GutendexError as e:
+        raise gutendex_http_error(e)
+
+
+async def get_books_by_ids(ids: List[int], aiohttpSession: aiohttp.ClientSession) -> Dict[int, dict]:
+    """
+    Fetches the book data of many books at once. The cached books are taken from
+    the book cache and the rest using the `ids` filter of gutendex. If gutendex is
+    unavailable, the expired cached books are served.
+    The ids are split in chunks that fit in one gutendex page and the chunks
+    are fetched concurrently, bounded by GUTENDEX_CONCURRENCY.
+    Returns the book data by book id.
+    """
+    chunk_size = Config.GUTENDEX_IDS_CHUNK_SIZE
+    semaphore = asyncio.Semaphore(Config.GUTENDEX_CONCURRENCY)
+
+    async def fetch_chunk(chunk: List[int]) -> List[dict]:
+        async with semaphore:
+            next = "{}/?ids={}".format(Config.GUTENDEX_URL,
+                                      ",".join(str(id) for id in chunk))
+            books = []
+            while next is not None:  # A chunk should fit in one page, but follow the pagination anyway
+                page, _ = await gutendex_client.get_json(url=next, aiohttpSession=aiohttpSession)
+                books += page["results"]
+                next = page["next"]
+            return books
+
+    result = await book_cache.get_many(ids)
+    missing = [id for id in ids if id not in result]
+    chunks = [missing[i:i + chunk_size]
+              for i in range(0, len(missing), chunk_size)]
     try:
-        async with aiohttpSession.get(url) as res:
-            if res.status != 200:
-                d = await res.json()
-                raise Exception(d["detail"])
-            res_data = await res.json()
-            return res_data["results"], res_data["next"]
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail="Could not fetch data from Gutendex: {}".format(e))
+        pages = await asyncio.gather(*[fetch_chunk(chunk) for chunk in chunks])
+    except GutendexUnavailable as e:
+        # Serve the books if they are all cached, even expired
+        stale = {id: book_cache.get_stale(id) for id in missing}
+        if None in stale.values():
+            raise gutendex_http_error(e)
+        result.update(stale)
+        return result
+    except GutendexError as e:
+        raise gutendex_http_error(e)
+    fetched = {book["id"]: book for page in pages for book in page}
+    await book_cache.set_many(fetched)
+    result.update(fetched)
+    return result
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import random
+import time
+from typing import Optional, Tuple
+import aiohttp
+from .Config import Config
+from .metrics import gutendex_errors, stage
+
+
+class GutendexError(Exception):
+    """
+    Gutendex answered with an error, e.g. a book that does not exist
+    """
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class GutendexUnavailable(GutendexError):
+    """
+    Gutendex could not be reached, timed out or failed on its side
+    """
+
+
+class CircuitOpenError(GutendexUnavailable):
+    """
+    Gutendex is not called, since it failed too many times recently
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures, so that calls fast-fail
+    instead of waiting on a gutendex that is down. After reset_timeout seconds
+    one trial call is let through (half open), its success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.reset()
+
+    def end_trial(self):
+        """
+        Ends a trial call that neither succeeded nor failed, e.g. a cancelled one,
+        so that the next call is let through as the trial
+        """
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class GutendexClient(object):
+    """
+    Client of the gutendex api. Every call retries the failures of gutendex (not its
+    answered errors) with exponential backoff and full jitter, goes through the circuit
+    breaker and, if hedge_delay is set, sends a second identical request when the first
+    one has not answered after hedge_delay seconds, using whichever answers first.
+    """
+
+    def __init__(self, retries: int, backoff_base: float, backoff_max: float, breaker: CircuitBreaker,
+                 attempt_timeout: Optional[float] = None, hedge_delay: Optional[float] = None):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.attempt_timeout = attempt_timeout
+        self.hedge_delay = hedge_delay
+
+    async def _attempt(self, url, aiohttpSession: aiohttp.ClientSession) -> Tuple[dict, int]:
+        kwargs = {}
+        if self.attempt_timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(
+                total=self.attempt_timeout)
+        try:
+            async with aiohttpSession.get(url, **kwargs) as res:
+                body = await res.read()
+                if res.status == 200:
+                    try:
+                        return json.loads(body), len(body)
+                    except ValueError:
+                        # E.g. the maintenance page of a proxy in front of gutendex
+                        gutendex_errors.inc(kind="invalid_json")
+                        raise GutendexUnavailable("Invalid json response")
+                try:
+                    detail = json.loads(body)["detail"]
+                except (ValueError, KeyError, TypeError):
+                    detail = "HTTP {}".format(res.status)
+                gutendex_errors.inc(kind=str(res.status))
+                if res.status >= 500 or res.status == 429:
+                    raise GutendexUnavailable(detail)
+                raise GutendexError(detail)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            gutendex_errors.inc(kind="timeout" if isinstance(
+                e, asyncio.TimeoutError) else "connection")
+            raise GutendexUnavailable(str(e) or type(e).__name__)
+
+    async def _hedged(self, url, aiohttpSession: aiohttp.ClientSession) -> Tuple[dict, int]:
+        if self.hedge_delay is None:
+            return await self._attempt(url, aiohttpSession)
+        first = asyncio.ensure_future(self._attempt(url, aiohttpSession))
+        pending = {first}
+        error = None
+        # The requests still running are cancelled however this ends, also if the caller is cancelled
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if done:
+                return first.result()
+            pending.add(asyncio.ensure_future(
+                self._attempt(url, aiohttpSession)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def get_json(self, url, aiohttpSession: aiohttp.ClientSession) -> Tuple[dict, int]:
+        """
+        Returns the json data of a gutendex url and the size of the response in bytes
+        """
+        trial = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            gutendex_errors.inc(kind="circuit_open")
+            raise CircuitOpenError("Gutendex is unavailable")
+        try:
+            with stage("gutendex"):
+                return await self._get_json(url, aiohttpSession)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    async def _get_json(self, url, aiohttpSession: aiohttp.ClientSession) -> Tuple[dict, int]:
+        for attempt in range(self.retries + 1):
+            try:
+                result = await self._hedged(url, aiohttpSession)
+            except GutendexUnavailable:
+                if attempt == self.retries:
+                    self.breaker.record_failure()
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+            except GutendexError:
+                # Gutendex answered, so it is up
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+
+gutendex_client = GutendexClient(
+    retries=Config.GUTENDEX_RETRIES,
+    backoff_base=Config.GUTENDEX_BACKOFF_BASE,
+    backoff_max=Config.GUTENDEX_BACKOFF_MAX,
+    breaker=CircuitBreaker(failure_threshold=Config.GUTENDEX_BREAKER_THRESHOLD,
+                           reset_timeout=Config.GUTENDEX_BREAKER_RESET_TIMEOUT),
+    attempt_timeout=Config.GUTENDEX_ATTEMPT_TIMEOUT,
+    hedge_delay=Config.GUTENDEX_HEDGE_DELAY)
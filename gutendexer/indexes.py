@@ -0,0 +1,80 @@
+from typing import Dict, List
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+# The indexes that the queries of the api need, by collection
+INDEXES: Dict[str, List[IndexModel]] = {
+    # Latest reviews of a book, and their keyset pagination
+    "reviews": [
+        IndexModel([("bookId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="bookId_createdAt_id")
+    ],
+    # Top rated books
+    "bookStats": [
+        IndexModel([("rating", DESCENDING), ("bookId", ASCENDING)],
+                   name="rating_bookId")
+    ],
+    # Monthly rollups of a book, optionally in a range of periods
+    "bookMonthlyStats": [
+        IndexModel([("bookId", ASCENDING), ("period", DESCENDING)],
+                   name="bookId_period")
+    ],
+    # Expire the entries of the shared book cache
+    "bookCache": [
+        IndexModel([("expiresAt", ASCENDING)],
+                   name="expiresAt_ttl", expireAfterSeconds=0)
+    ]
+}
+
+# The indexes that were replaced by one of the required indexes, by collection
+SUPERSEDED_INDEXES: Dict[str, List[str]] = {
+    # Replaced by bookId_createdAt_id, which also orders the reviews of the same time
+    "reviews": ["bookId_createdAt"]
+}
+
+
+async def drop_superseded_indexes(db):
+    """
+    Drops the superseded indexes that still exist, so that they are not maintained on every write
+    """
+    for collection, names in SUPERSEDED_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+
+
+async def ensure_indexes(db):
+    """
+    Creates the required indexes that do not exist yet and drops the superseded ones.
+    It is idempotent, so it runs on every startup.
+    """
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+    await drop_superseded_indexes(db)
+
+
+async def missing_indexes(db) -> Dict[str, List[str]]:
+    """
+    Returns the names of the required indexes that do not exist, by collection
+    """
+    missing = {}
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        names = [index.document["name"]
+                 for index in indexes if index.document["name"] not in existing]
+        if names:
+            missing[collection] = names
+    return missing
+
+
+async def rebuild_indexes(db):
+    """
+    Drops and recreates the required indexes, and drops the superseded ones
+    """
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        for index in indexes:
+            if index.document["name"] in existing:
+                await db[collection].drop_index(index.document["name"])
+        await db[collection].create_indexes(indexes)
+    await drop_superseded_indexes(db)
@@ -1,11 +1,48 @@
 from fastapi import FastAPI
-from .routes import books
+from .routes import books, metrics
+from .profiling import profile_requests
+from .clients import mongo_registry, http_registry
+from .cache import book_cache, search_cache
+from .catalog import catalog
+from .Config import Config
+from .indexes import ensure_indexes
+from .crud.reviews import review_buffer
 
 app = FastAPI()
 
 app.include_router(books.router)
+app.include_router(metrics.router)
+app.middleware("http")(metrics.record_metrics)
+app.middleware("http")(profile_requests)
+
+
+@app.on_event("startup")
+async def startup():
+    # One pooled mongo client for the whole process
+    client = mongo_registry.connect()
+    if Config.MONGO_ENSURE_INDEXES:
+        await ensure_indexes(client.get_default_database())
+    # One aiohttp session with warm connections to gutendex
+    http_registry.connect()
+    if Config.REVIEW_WRITE_BEHIND:
+        review_buffer.start()
+    if Config.LOCAL_CATALOG:  # Build the title index before serving searches
+        await catalog.load()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Write the buffered reviews before closing the mongo client
+    await review_buffer.stop()
+    mongo_registry.close()
+    await http_registry.close()
 
 
 @app.get("/")
 async def root():
     return {"message": "Gutendexer API"}
+
+
+@app.get("/cache-stats/")
+async def cache_stats():
+    return {"books": book_cache.stats(), "searches": search_cache.stats()}
@@ -0,0 +1,205 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The route of the request being served, set by the metrics middleware
+current_route = ContextVar("current_route", default="")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(object):
+    """
+    A metric with labels, rendered in the prometheus text format
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """
+        Yields the name, label names, label values and value of every sample
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for name, label_names, label_values, value in self.samples():
+            lines.append("{}{} {}".format(name, format_labels(label_names, label_values), format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, self.labels, key, value
+
+    def clear(self):
+        self.values.clear()
+
+
+class Gauge(Metric):
+    """
+    A gauge whose values are collected when the metrics are rendered,
+    collect returns the values by label values
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self):
+        for key, value in self.collect().items():
+            yield self.name, self.labels, key, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per label values, the count of every bucket (not cumulative), the sum and the count
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket", names, key + (format_value(bound),), cumulative
+            yield self.name + "_sum", self.labels, key, counts[-2]
+            yield self.name + "_count", self.labels, key, counts[-1]
+
+    def clear(self):
+        self.values.clear()
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Duration of the http requests", ["method", "route", "status"]))
+stage_duration = registry.register(Histogram(
+    "stage_duration_seconds", "Duration of the stages of the requests (mongo, gutendex, serialization)", ["route", "stage", "status"]))
+gutendex_errors = registry.register(Counter(
+    "gutendex_errors_total", "Failed gutendex requests, by status code, timeout, connection, invalid_json or circuit_open", ["kind"]))
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a stage of the current request, e.g. a mongo aggregation, in the stage histogram
+    """
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - started,
+                               route=current_route.get(), stage=name, status=status)
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """
+    Keeps the number of open and checked out connections of the mongo connection pools
+    """
+
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+
+mongo_pool_listener = MongoPoolListener()
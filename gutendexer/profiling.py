@@ -0,0 +1,158 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import pstats
+import random
+import re
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+from bson import json_util
+from fastapi import Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
+from .Config import Config
+
+try:
+    import pyinstrument
+except ImportError:  # pyinstrument is optional, cProfile is used without it
+    pyinstrument = None
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(__name__ + ".slow_queries")
+
+
+class RequestProfiler(object):
+    """
+    Profiles a request, with the async aware sampling profiler of pyinstrument if it is installed.
+    Otherwise cProfile is used, which also counts whatever other requests run at the same time.
+    """
+
+    def __init__(self):
+        if pyinstrument is not None:
+            self._profiler = pyinstrument.Profiler(async_mode="enabled")
+        else:
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if pyinstrument is not None:
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if pyinstrument is not None:
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def output(self) -> Tuple[str, str]:
+        """
+        Returns the profile and its file extension
+        """
+        if pyinstrument is not None:
+            return self._profiler.output_html(), "html"
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats("cumulative").print_stats(50)
+        return stream.getvalue(), "txt"
+
+
+# Only one profiler can be active in a thread at a time
+_profiling = False
+
+
+def should_profile(request: Request) -> Tuple[bool, bool]:
+    """
+    Returns whether the request is profiled and whether the profile is returned
+    instead of the response (asked with the profile header set to PROFILE_SECRET) or stored (sampled)
+    """
+    if not Config.PROFILING:
+        return False, False
+    header = request.headers.get(Config.PROFILE_HEADER)
+    if header is not None and Config.PROFILE_SECRET and hmac.compare_digest(
+            header.encode(), Config.PROFILE_SECRET.encode()):
+        return True, True
+    if _profiling:
+        return False, False
+    return Config.PROFILE_SAMPLE_RATE > 0 and random.random() < Config.PROFILE_SAMPLE_RATE, False
+
+
+def store_profile(request: Request, profile: str, extension: str) -> Path:
+    directory = Path(Config.PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = "{}-{}-{}.{}".format(time.strftime("%Y%m%dT%H%M%S"), request.method,
+                                re.sub(r"[^A-Za-z0-9]+", "_", request.url.path).strip("_") or "root", extension)
+    path = directory / name
+    path.write_text(profile)
+    return path
+
+
+async def profile_requests(request: Request, call_next):
+    """
+    Middleware that profiles a request when PROFILING is enabled, either when its PROFILE_HEADER
+    header is PROFILE_SECRET, and then the profile is returned instead of the response,
+    or for a PROFILE_SAMPLE_RATE fraction of the requests, whose profiles are stored in PROFILE_DIR.
+    A profile asked with the header while another request is profiled is answered with 409.
+    """
+    global _profiling
+    profile, respond = should_profile(request)
+    if not profile:
+        return await call_next(request)
+    if _profiling:
+        logger.warning("Profile of %s %s skipped, another request is profiled", request.method, request.url.path)
+        return PlainTextResponse("Another request is profiled, try again later", status_code=409)
+    _profiling = True
+    profiler = RequestProfiler()
+    profiler.start()
+    try:
+        response = await call_next(request)
+        # Read the whole body, so that a streamed response is profiled too
+        body = b"".join([chunk async for chunk in response.body_iterator])
+    finally:
+        profiler.stop()
+        _profiling = False
+    output, extension = profiler.output()
+    if respond:
+        if extension == "html":
+            return HTMLResponse(output)
+        return PlainTextResponse(output)
+    path = store_profile(request, output, extension)
+    logger.info("Profile of %s %s stored in %s", request.method, request.url.path, path)
+    return Response(content=body, status_code=response.status_code,
+                    headers=dict(response.headers), media_type=response.media_type)
+
+
+async def explain_aggregation(collection, pipeline: List[dict]) -> dict:
+    return await collection.database.command(
+        "explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+        verbosity=Config.SLOW_QUERY_EXPLAIN_VERBOSITY)
+
+
+async def log_slow_aggregation(collection, pipeline: List[dict], duration: float):
+    """
+    Logs an aggregation that took longer than SLOW_QUERY_MS, with its explain output
+    """
+    try:
+        explain = json_util.dumps(await explain_aggregation(collection, pipeline))
+    except Exception as e:
+        explain = "explain failed: {}".format(e)
+    slow_query_logger.warning("Slow aggregation on %s took %.1fms, pipeline: %s, explain: %s",
+                              collection.name, duration * 1000, json_util.dumps(pipeline), explain)
+
+
+# The slow aggregations being logged, an unreferenced task could be garbage collected before it ends
+_slow_query_tasks = set()
+
+
+def check_slow_aggregation(collection, pipeline: List[dict], duration: float) -> Optional[asyncio.Future]:
+    """
+    Explains and logs the aggregation in the background if it was slow,
+    so that the explain does not delay the response
+    """
+    if Config.SLOW_QUERY_MS is None or duration * 1000 < Config.SLOW_QUERY_MS:
+        return None
+    task = asyncio.ensure_future(log_slow_aggregation(collection, pipeline, duration))
+    _slow_query_tasks.add(task)
+    task.add_done_callback(_slow_query_tasks.discard)
+    return task
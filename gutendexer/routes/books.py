@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from motor.motor_tornado import MotorClientSession
 import aiohttp
-from typing import List
+import re
+from typing import AsyncIterator, List, Optional, Union
+from pydantic import BaseModel
 
-from ..schemas.book import Book, BookAverageMonthlyRating, BookBase, PaginatedBookList
+from ..Config import Config
+from ..schemas.book import Book, BookAverageMonthlyRating, BookBase, BookRatings, PaginatedBookList
+from .caching import cached_json_response, is_not_modified, make_etag, not_modified_response, uncached_json_response
 from .dependencies import get_db_session, get_aiohttp_session
-from ..crud.books import get_book_info, add_review, get_books_by_title, get_top_books_by_rating, get_book_monthly_average_ratings, get_books_by_title_paginated
-from ..schemas.review import ReviewCreate
+from .responses import FastJSONResponse, dumps
+from ..crud.books import get_book_info, get_book_review_version, get_books_info, add_review, get_books_by_title, get_books_by_title_stream, get_top_books_by_rating, get_book_monthly_average_ratings, get_book_reviews, get_books_by_title_paginated
+from ..crud.reviews import add_reviews
+from ..schemas.review import BulkReviewResult, PaginatedReviewList, ReviewCreate
 
 router = APIRouter(
     prefix="/books",
@@ -14,29 +21,184 @@ router = APIRouter(
 )
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def to_ndjson(books: AsyncIterator[BaseModel]) -> AsyncIterator[bytes]:
+    async for book in books:
+        yield dumps(book) + b"\n"
+
+
+# The characters that delimit the items of a json array, or change how the others are read
+JSON_ARRAY_TOKENS = re.compile(rb'[\[\]{},"\\]')
+
+
+async def split_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Yields the raw json of every item of a json array while its chunks arrive, without
+    parsing the items, so that every item is validated on its own and an invalid item is
+    reported like an invalid line of newline delimited json. A body that does not start
+    as an array is rejected, and anything after the end of the array is yielded as an item.
+    """
+    depth = 0  # Nesting level, the items of the array are at level 1
+    in_string = escaped = started = ended = False
+    items = 0
+    item = bytearray()
+    async for chunk in chunks:
+        position = start = 0
+        if escaped and chunk:  # The escaped character is the first of this chunk
+            position, escaped = 1, False
+        while not ended:
+            match = JSON_ARRAY_TOKENS.search(chunk, position)
+            if match is None:
+                break
+            token, position = chunk[match.start():match.end()], match.end()
+            if in_string:
+                if token == b"\\":
+                    escaped = position == len(chunk)
+                    position += 1
+                elif token == b'"':
+                    in_string = False
+            elif not started:
+                if token != b"[" or chunk[start:match.start()].strip():
+                    raise HTTPException(status_code=400, detail="Body should be a json array")
+                started = True
+                depth, start = 1, position
+            elif token == b'"':
+                in_string = True
+            elif token in (b"[", b"{"):
+                depth += 1
+            elif token in (b"]", b"}"):
+                depth -= 1
+                if depth == 0:
+                    item += chunk[start:match.start()]
+                    if item.strip() or items:
+                        yield bytes(item)
+                    item.clear()
+                    ended, start = True, position
+            elif token == b"," and depth == 1:
+                item += chunk[start:match.start()]
+                yield bytes(item)
+                items += 1
+                item.clear()
+                start = position
+        if not started:
+            if chunk.strip():
+                raise HTTPException(status_code=400, detail="Body should be a json array")
+            continue
+        item += chunk[start:]
+    if not started:
+        raise HTTPException(status_code=400, detail="Body should be a json array")
+    if item.strip():  # An unterminated array or trailing data
+        yield bytes(item)
+
+
+async def read_bulk_reviews(request: Request) -> AsyncIterator[Union[str, dict]]:
+    """
+    Yields the reviews of a bulk import body, either newline delimited json,
+    read line by line while the body is received, or the items of a json array,
+    also read while the body is received.
+    """
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+        return
+    async for item in split_json_array(request.stream()):
+        yield item
+
+
+@router.get("/", response_model=List[Book])
+async def get_books(ids: str = Query(..., description="Comma separated book ids, e.g. 1,2,3"), mongoSession: MotorClientSession = Depends(get_db_session), aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
+    return await get_books_info(ids=ids, mongoSession=mongoSession, aiohttpSession=aiohttpSession)
+
+
 @router.get("/search/", response_model=List[BookBase])
-async def search(title: str, aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
-    return await get_books_by_title(title=title, aiohttpSession=aiohttpSession)
+async def search(request: Request, title: str, stream: bool = False, aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
+    """
+    Returns all the books matching the title. With `stream=true` or an
+    `Accept: application/x-ndjson` header, the books are streamed as
+    newline delimited json while the gutendex pages arrive.
+    The books are validated once, when they are built from the gutendex data,
+    so they are serialized as they are and not through the response_model.
+    """
+    if stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        books = await get_books_by_title_stream(title=title, aiohttpSession=aiohttpSession)
+        return StreamingResponse(to_ndjson(books), media_type=NDJSON_MEDIA_TYPE)
+    return FastJSONResponse(await get_books_by_title(title=title, aiohttpSession=aiohttpSession))
 
 
 @router.get("/search-paginated/", response_model=PaginatedBookList)
-async def search_paginated(title: str, page: int = 1, aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
-    return await get_books_by_title_paginated(title=title, page=page, aiohttpSession=aiohttpSession)
+async def search_paginated(title: str, page: int = 1, pageSize: Optional[int] = None, aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
+    """
+    Returns a page of the books matching the title. By default the pages are
+    the gutendex pages, with a pageSize they are assembled from them.
+    """
+    return FastJSONResponse(await get_books_by_title_paginated(title=title, page=page, pageSize=pageSize, aiohttpSession=aiohttpSession))
 
 
 @router.get("/top/", response_model=List[Book])
-async def top_books(amount: int = 10, mongoSession: MotorClientSession = Depends(get_db_session), aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
-    return await get_top_books_by_rating(amount=amount, mongoSession=mongoSession, aiohttpSession=aiohttpSession)
+async def top_books(request: Request, amount: int = 10, mongoSession: MotorClientSession = Depends(get_db_session), aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
+    """
+    Returns the top rated books. The etag is the hash of the response.
+    """
+    books = await get_top_books_by_rating(amount=amount, mongoSession=mongoSession, aiohttpSession=aiohttpSession)
+    return cached_json_response(request, books, max_age=Config.TOP_BOOKS_MAX_AGE)
 
 
-@router.get("/{bookId}/", response_model=Book)
-async def get_book(bookId: int, mongoSession: MotorClientSession = Depends(get_db_session), aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
-    return await get_book_info(bookId=bookId, mongoSession=mongoSession, aiohttpSession=aiohttpSession)
+@router.post("/reviews/bulk/", response_model=BulkReviewResult)
+async def bulk_reviews(request: Request, mongoSession: MotorClientSession = Depends(get_db_session)):
+    """
+    Imports many reviews, of any book, at once. The body is either a json array
+    or newline delimited json (`Content-Type: application/x-ndjson`) of reviews
+    with their bookId and optionally their createdAt.
+    The invalid reviews are reported by their index, the rest are inserted.
+    """
+    return await add_reviews(reviews=read_bulk_reviews(request), mongoSession=mongoSession)
+
+
+@router.get("/{bookId}/", response_model=Union[Book, BookRatings])
+async def get_book(request: Request, bookId: int, mongoSession: MotorClientSession = Depends(get_db_session), aiohttpSession: aiohttp.ClientSession = Depends(get_aiohttp_session)):
+    """
+    Returns a book with its ratings. The etag is the review version of the book,
+    so a client that has the latest version gets a 304 without gutendex being called.
+    A partial book (without the gutendex info) is not cached.
+    """
+    version = await get_book_review_version(bookId=bookId, mongoSession=mongoSession)
+    etag = make_etag("book", bookId, version.get("count", 0), version.get("updatedAt"), weak=True)
+    last_modified = version.get("updatedAt")
+    if is_not_modified(request, etag=etag, last_modified=last_modified):
+        return not_modified_response(max_age=Config.BOOK_MAX_AGE, etag=etag, last_modified=last_modified)
+    book = await get_book_info(bookId=bookId, mongoSession=mongoSession, aiohttpSession=aiohttpSession, stats=version)
+    if isinstance(book, BookRatings):
+        return uncached_json_response(book)
+    return cached_json_response(request, book, max_age=Config.BOOK_MAX_AGE, etag=etag, last_modified=last_modified)
 
 
 @router.get("/{bookId}/monthly-average/", response_model=BookAverageMonthlyRating)
-async def get_book_monthly_average(bookId: int, mongoSession: MotorClientSession = Depends(get_db_session)):
-    return await get_book_monthly_average_ratings(bookId=bookId, mongoSession=mongoSession)
+async def get_book_monthly_average(request: Request, bookId: int, fromMonth: Optional[str] = Query(None, alias="from", description="First month, YYYY-MM"), toMonth: Optional[str] = Query(None, alias="to", description="Last month, YYYY-MM"), mongoSession: MotorClientSession = Depends(get_db_session)):
+    """
+    Returns the monthly average ratings of a book, versioned like the book by its reviews.
+    """
+    version = await get_book_review_version(bookId=bookId, mongoSession=mongoSession)
+    etag = make_etag("monthly-average", bookId, fromMonth, toMonth,
+                     version.get("count", 0), version.get("updatedAt"))
+    last_modified = version.get("updatedAt")
+    if is_not_modified(request, etag=etag, last_modified=last_modified):
+        return not_modified_response(max_age=Config.MONTHLY_AVERAGE_MAX_AGE, etag=etag, last_modified=last_modified)
+    monthly_average = await get_book_monthly_average_ratings(bookId=bookId, mongoSession=mongoSession, fromMonth=fromMonth, toMonth=toMonth)
+    return cached_json_response(request, monthly_average, max_age=Config.MONTHLY_AVERAGE_MAX_AGE, etag=etag, last_modified=last_modified)
+
+
+@router.get("/{bookId}/reviews/", response_model=PaginatedReviewList)
+async def get_reviews(bookId: int, limit: int = 20, cursor: Optional[str] = None, mongoSession: MotorClientSession = Depends(get_db_session)):
+    return await get_book_reviews(bookId=bookId, limit=limit, cursor=cursor, mongoSession=mongoSession)
 
 
 @router.post("/{bookId}/review/")
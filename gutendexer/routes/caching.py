@@ -0,0 +1,95 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from hashlib import sha1
+from typing import Any, Optional
+from ..Config import Config
+from ..metrics import stage
+
+
+def make_etag(*parts: Any, weak: bool = False) -> str:
+    """
+    Returns an etag out of the given parts, e.g. a book id and its review version.
+    The app version is part of it, so that the etags change with the response format.
+    """
+    digest = sha1("|".join(str(part) for part in (Config.VERSION,) + parts).encode()).hexdigest()
+    return '{}"{}"'.format("W/" if weak else "", digest)
+
+
+def content_etag(body: bytes) -> str:
+    """
+    Returns the etag of a response body
+    """
+    return '"{}"'.format(sha1(body).hexdigest())
+
+
+def http_date(value: datetime) -> str:
+    """
+    Formats a datetime as an http date, naive datetimes are taken as UTC like in mongo
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """
+    Checks the conditional headers of a request. If-None-Match is compared weakly
+    with the etag and, only when it is missing, If-Modified-Since with last_modified.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return etag.replace("W/", "", 1) in [tag.replace("W/", "", 1) for tag in tags]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        # Http dates have no fractions of a second
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def cache_headers(max_age: int, etag: Optional[str] = None, last_modified: Optional[datetime] = None) -> dict:
+    headers = {"Cache-Control": "public, max-age={}".format(max_age)}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified_response(max_age: int, etag: str, last_modified: Optional[datetime] = None) -> Response:
+    return Response(status_code=304, headers=cache_headers(max_age=max_age, etag=etag, last_modified=last_modified))
+
+
+def cached_json_response(request: Request, content: Any, max_age: int, etag: Optional[str] = None, last_modified: Optional[datetime] = None) -> Response:
+    """
+    Returns the content as a json response with the caching headers.
+    Without an etag, the etag is the hash of the body, and a 304 is
+    returned if the client already has the same body.
+    """
+    with stage("serialize"):
+        response = JSONResponse(content=jsonable_encoder(content))
+    if etag is None:
+        etag = content_etag(response.body)
+        if is_not_modified(request, etag=etag):
+            return not_modified_response(max_age=max_age, etag=etag, last_modified=last_modified)
+    response.headers.update(cache_headers(max_age=max_age, etag=etag, last_modified=last_modified))
+    return response
+
+
+def uncached_json_response(content: Any) -> Response:
+    """
+    Returns the content as a json response that should be revalidated on every use,
+    e.g. a partial response
+    """
+    return JSONResponse(content=jsonable_encoder(content), headers={"Cache-Control": "no-cache"})
@@ -1,17 +1,13 @@
 from typing import Generator
-import motor.motor_asyncio
-import aiohttp
-from ..Config import Config
+from ..clients import mongo_registry, http_registry
 
 
 async def get_db_session() -> Generator:
     """
-    Database session/connection to be used per request, it is passed as a dependency to the endpoints
+    Database session to be used per request, it is passed as a dependency to the endpoints.
+    The session is taken from the process wide pooled client.
     """
-    client = motor.motor_asyncio.AsyncIOMotorClient(
-        "mongodb://{}:{}@{}/{}".format(
-            Config.MONGO_USER, Config.MONGO_PASSWORD, Config.MONGO_HOST, Config.DATABASE))
-    session = await client.start_session()
+    session = await mongo_registry.client.start_session()
     try:
         yield session
     finally:
@@ -21,10 +17,7 @@ async def get_db_session() -> Generator:
 async def get_aiohttp_session() -> Generator:
     """
     aiohttp session to be passed as a dependency to the endpoints.
-    It is used to contact gutendex api inside the routes
+    It is used to contact gutendex api inside the routes.
+    The session is shared by the whole app and closed on shutdown, not per request.
     """
-    session = aiohttp.ClientSession()
-    try:
-        yield session
-    finally:
-        await session.close()
+    yield http_registry.session
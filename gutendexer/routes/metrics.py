@@ -0,0 +1,68 @@
+import time
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Match
+from ..Config import Config
+from ..cache import LRUCache, book_cache, search_cache
+from ..clients import http_registry
+from ..metrics import Gauge, current_route, http_request_duration, mongo_pool_listener, registry
+
+router = APIRouter(tags=["metrics"])
+
+
+def route_path(request: Request) -> str:
+    """
+    Returns the path template of the route of a request, e.g. /books/{bookId}/,
+    so that the metrics are not labeled by every book id
+    """
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+async def record_metrics(request: Request, call_next):
+    """
+    Middleware that times every request by route and status, the stages timed
+    while serving the request are labeled with its route too
+    """
+    route = route_path(request)
+    token = current_route.set(route)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_request_duration.observe(time.perf_counter() - started,
+                                      method=request.method, route=route, status=status)
+        current_route.reset(token)
+
+
+def hit_ratio(cache: LRUCache) -> float:
+    requests = cache.hits + cache.misses
+    return cache.hits / requests if requests else 0
+
+
+registry.register(Gauge("mongo_pool_connections", "Connections of the mongo pool", ["state"], collect=lambda: {
+    ("open",): mongo_pool_listener.open,
+    ("checked_out",): mongo_pool_listener.checked_out,
+    ("max",): Config.MONGO_MAX_POOL_SIZE}))
+registry.register(Gauge("gutendex_pool_connections", "Connections of the gutendex http pool", ["state"], collect=lambda: {
+    (state,): value for state, value in http_registry.pool_stats().items()}))
+registry.register(Gauge("cache_hit_ratio", "Hit ratio of the in-process caches", ["cache"], collect=lambda: {
+    ("books",): hit_ratio(book_cache.local),
+    ("searches",): hit_ratio(search_cache.cache)}))
+registry.register(Gauge("cache_entries", "Entries of the in-process caches", ["cache"], collect=lambda: {
+    ("books",): len(book_cache.local),
+    ("searches",): len(search_cache.cache)}))
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    The metrics in the prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,43 @@
+import json
+from datetime import date, datetime
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Any
+from ..metrics import stage
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard json module is used without it
+    orjson = None
+
+
+def default(obj: Any) -> Any:
+    """
+    Serializes what json can not, the pydantic models are serialized as they are, without being validated again
+    """
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Serializes the content to json, with orjson if it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=default)
+    return json.dumps(content, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response for content that is already validated, e.g. a list of pydantic models.
+    Returning it from a route skips the response_model validation and the jsonable_encoder
+    of FastAPI, which are slow for large lists of books.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with stage("serialize"):
+            return dumps(content)
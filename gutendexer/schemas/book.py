@@ -18,7 +18,20 @@ class BookBase(BaseModel):
 
 class Book(BookBase):
     rating: Optional[float] = None
+    # The latest reviews only, reviewCount is the total amount
     reviews: Optional[List[str]]
+    reviewCount: int = 0
+
+
+class BookRatings(BaseModel):
+    """
+    The review information of a book, without the gutendex book info
+    """
+    id: int
+    rating: Optional[float] = None
+    reviews: Optional[List[str]]
+    reviewCount: int = 0
+    partial: bool = True
 
 
 class AverageMonthlyRating(BaseModel):
@@ -1,7 +1,7 @@
 import datetime
-from datetime import datetime
-from pydantic import BaseModel, validator
-from typing import Optional
+from datetime import datetime, timezone
+from pydantic import BaseModel, Field, validator
+from typing import List, Optional
 
 
 class ReviewBase(BaseModel):
@@ -15,10 +15,38 @@ class ReviewCreate(ReviewBase):
 
 class Review(ReviewBase):
     bookId: int
-    createdAt: datetime = datetime.now()
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
 
     @validator('rating')
     def check_rating(cls, v):
         if v > 5 or v < 0:
             raise ValueError('Rating is not between 0 and 5')
         return v
+
+    @validator('createdAt')
+    def to_naive_utc(cls, v):
+        # Mongo stores naive UTC datetimes, and the reviews of a batch are compared with each other
+        if v.tzinfo is not None:
+            v = v.astimezone(timezone.utc).replace(tzinfo=None)
+        return v
+
+
+class BookReview(ReviewBase):
+    createdAt: datetime
+
+
+class PaginatedReviewList(BaseModel):
+    bookId: int
+    totalCount: int
+    reviews: List[BookReview]
+    nextCursor: Optional[str] = None
+
+
+class BulkReviewError(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkReviewResult(BaseModel):
+    inserted: int
+    errors: List[BulkReviewError]
@@ -5,8 +5,12 @@ from fastapi import FastAPI
 import pytest
 from typing import Generator
 from typing import Any
-from ..routes import books
+from ..routes import books, metrics
 from ..routes.dependencies import get_db_session
+from ..cache import book_cache, search_cache
+from ..clients import mongo_registry
+from ..gutendex import gutendex_client
+from ..crud.stats import rebuild_book_stats
 import asyncio
 import sys
 import os
@@ -23,9 +27,31 @@ def start_application():
     app = FastAPI()
     # Add routers to the app
     app.include_router(books.router)
+    app.include_router(metrics.router)
+    app.middleware("http")(metrics.record_metrics)
     return app
 
 
+@pytest.fixture(scope="session", autouse=True)
+def use_test_database():
+    # Code that uses the app wide mongo client should connect to the test database too
+    database = Config.DATABASE
+    Config.DATABASE = Config.DATABASE_TEST
+    mongo_registry.close()
+    yield None
+    mongo_registry.close()
+    Config.DATABASE = database
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clear_caches():
+    # Every test mocks gutendex on its own, so nothing should be served from a previous test
+    await book_cache.clear()
+    await search_cache.clear()
+    gutendex_client.breaker.reset()
+    yield None
+
+
 @pytest.fixture
 def aioresponses():
     with aioresponses_.aioresponses() as aior:
@@ -40,7 +66,7 @@ async def create_db():
     # Using default database according to the connection string, This way we can use different database for tests and different for normal app
     db = client.get_default_database()
     collection = db.reviews
-    await collection.insert_many([
+    result = await collection.insert_many([
         {
             "bookId": 1,
             "rating": 0,
@@ -78,8 +104,22 @@ async def create_db():
             "createdAt": datetime.strptime("02/10/22", '%d/%m/%y')
         }
     ])
-    yield None
+    # The reviews are inserted directly, so the rating summaries and rollups have to be backfilled
+    await rebuild_book_stats(db)
+    yield result.inserted_ids
     await collection.delete_many({})
+    await db.bookStats.delete_many({})
+    await db.bookMonthlyStats.delete_many({})
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def reset_reviews(create_db):
+    # Every test starts from the fixture reviews, so the tests do not depend on their order
+    db = mongo_registry.client.get_default_database()
+    removed = await db.reviews.delete_many({"_id": {"$nin": create_db}})
+    if removed.deleted_count:
+        await rebuild_book_stats(db)
+    yield None
 
 
 @pytest_asyncio.fixture(scope="session")
@@ -1,6 +1,17 @@
+import asyncio
 import json
+import re
+import time
 import pytest
+from fastapi import HTTPException
+from datetime import datetime
 from gutendexer.Config import Config
+from gutendexer.cache import book_cache
+from gutendexer.crud import books as books_crud
+from gutendexer.crud import reviews as reviews_crud
+from gutendexer.crud.stats import update_book_stats
+from gutendexer.gutendex import gutendex_client
+from gutendexer.routes.books import split_json_array
 from gutendexer.schemas.review import ReviewCreate
 
 
@@ -14,6 +25,30 @@ async def test_add_review(client):
     assert response.status_code == 200
 
 
+@pytest.mark.asyncio
+async def test_add_review_stats_failure(client, mongoSession, monkeypatch):
+    """
+    Tests that a review whose rating summaries fail to update is undone,
+    so that a retry of the client is not counted twice
+    """
+    update_book_stats = books_crud.update_book_stats
+
+    async def failing_update_book_stats(db, reviews, session=None):
+        # The summary is updated but not the monthly rollups
+        await update_book_stats(db=db, reviews=reviews, session=session)
+        raise RuntimeError("Rollups unavailable")
+
+    monkeypatch.setattr(books_crud, "update_book_stats", failing_update_book_stats)
+    data = ReviewCreate(rating=5, review="A failed review")
+    response = await client.post("/books/2/review/", data=json.dumps(data.dict()))
+    assert response.status_code == 500
+    db = mongoSession.client.get_default_database()
+    assert await db.reviews.count_documents({"review": "A failed review"}) == 0
+    stats = await db.bookStats.find_one({"_id": 2})
+    assert stats["count"] == 1
+    assert stats["rating"] == 3
+
+
 @pytest.mark.asyncio
 async def test_get_book(client, aioresponses):
     """
@@ -65,6 +100,29 @@ async def test_get_book(client, aioresponses):
             assert data["reviews"] == None
 
 
+@pytest.mark.asyncio
+async def test_get_book_cached(client, aioresponses):
+    """
+    Tests that the gutendex book data is cached between requests
+    """
+    payload = {
+        "id": 5,
+        "title": "test",
+        "languages": ["en"],
+        "download_count": 10,
+        "authors": []
+    }
+    # Mocked only once, the second request has to be served from the cache
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 5),
+                     status=200, payload=payload)
+    for _ in range(2):
+        response = await client.get(url="/books/5/")
+        assert response.status_code == 200
+        assert response.json()["title"] == "test"
+    assert book_cache.local.hits == 1
+    assert book_cache.local.misses == 1
+
+
 @pytest.mark.asyncio
 async def test_get_book_gutendex_exception(client, aioresponses):
     id = 100
@@ -143,6 +201,90 @@ async def test_search_book(client, aioresponses):
     assert data[1]["id"] == 3
 
 
+@pytest.mark.asyncio
+async def test_search_book_parallel_pages(client, aioresponses, monkeypatch):
+    """
+    Tests that the pages of a search are fetched concurrently and assembled in order
+    """
+    title = "Parallel title"
+    books = [{
+        "id":  id,
+        "title": "Parallel title {}".format(id),
+        "languages": ["en"],
+        "download_count": 10,
+        "authors": [{
+            "name": "author",
+            "birth_year": 1987,
+            "death_year": None
+        }]
+    } for id in range(1, 8)]
+    for page in range(1, 5):
+        url = "{}/?search={}".format(Config.GUTENDEX_URL, title)
+        if page > 1:
+            url += "&page={}".format(page)
+        aioresponses.get(url, status=200, payload={
+            "count": len(books),
+            "next": "{}/?search={}&page={}".format(Config.GUTENDEX_URL, title, page + 1) if page < 4 else None,
+            "previous": None,
+            "results": books[(page - 1) * 2:page * 2]
+        })
+
+    monkeypatch.setattr(Config, "GUTENDEX_CONCURRENCY", 2)
+    response = await client.get(url="/books/search/?title={}".format(title))
+    assert response.status_code == 200
+    assert [book["id"] for book in response.json()] == list(range(1, 8))
+
+
+@pytest.mark.asyncio
+async def test_search_book_stream(client, aioresponses):
+    """
+    Tests streaming the searched books as newline delimited json
+    """
+    title = "Streamed title"
+    for page in range(1, 3):
+        url = "{}/?search={}".format(Config.GUTENDEX_URL, title)
+        if page > 1:
+            url += "&page={}".format(page)
+        aioresponses.get(url, status=200, payload={
+            "count": 3,
+            "next": "{}/?search={}&page=2".format(Config.GUTENDEX_URL, title) if page == 1 else None,
+            "previous": None,
+            "results": [{
+                "id":  id,
+                "title": "Streamed title" if id != 2 else "Filtered out",
+                "languages": ["en"],
+                "download_count": 10,
+                "authors": [{
+                    "name": "author",
+                    "birth_year": 1987,
+                    "death_year": None
+                }]
+            } for id in ([1, 2] if page == 1 else [3])]
+        })
+
+    response = await client.get(url="/books/search/?title={}&stream=true".format(title))
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_search_book_stream_gutendex_exception(client, aioresponses):
+    """
+    Tests that a gutendex error on the first page is still returned as an error when streaming
+    """
+    title = "Exception title"
+    aioresponses.get("{}/?search={}".format(Config.GUTENDEX_URL, title),
+                     status=400, payload={"detail": "Not found."})
+
+    response = await client.get(url="/books/search/?title={}".format(title),
+                                headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 500
+    assert response.json()[
+        "detail"] == "Could not fetch data from Gutendex: Not found."
+
+
 @pytest.mark.asyncio
 async def test_search_book_gutendex_exception(client, aioresponses):
     """
@@ -159,10 +301,11 @@ async def test_search_book_gutendex_exception(client, aioresponses):
 
 
 @pytest.mark.asyncio
-async def test_search_book_paginated(client, aioresponses):
+async def test_search_book_paginated(client, aioresponses, monkeypatch):
     """
     Tests searching a book using pagination
     """
+    monkeypatch.setattr(Config, "SEARCH_PREFETCH", False)
     title = "A book title"
 
     payload = {
@@ -242,14 +385,103 @@ async def test_search_book_paginated(client, aioresponses):
     assert data["books"][0]["id"] == 3
 
 
-# TODO: add test for the validation of the page value
+
+@pytest.mark.asyncio
+async def test_search_book_paginated_cached(client, aioresponses):
+    """
+    Tests that concurrent identical searches share one gutendex request, which is cached
+    """
+    title = "Cached title"
+    # Mocked only once, all the requests have to be served by it
+    aioresponses.get("{}?search={}&page=1".format(Config.GUTENDEX_URL, title), status=200, payload={
+        "count": 1,
+        "next": None,
+        "previous": None,
+        "results": [{
+            "id":  1,
+            "title": "Cached title",
+            "languages": ["en"],
+            "download_count": 10,
+            "authors": []
+        }]
+    })
+    responses = await asyncio.gather(*[client.get(
+        url="/books/search-paginated/?title={}".format(title)) for _ in range(3)])
+    # Same normalized search
+    responses.append(await client.get(url="/books/search-paginated/?title={}".format(title.upper())))
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json()["books"][0]["id"] == 1
+
+
+def search_page_payload(title: str, page: int, count: int, page_size: int) -> dict:
+    ids = range((page - 1) * page_size + 1, min(page * page_size, count) + 1)
+    return {
+        "count": count,
+        "next": "{}?search={}&page={}".format(Config.GUTENDEX_URL, title, page + 1) if page * page_size < count else None,
+        "previous": "{}?search={}&page={}".format(Config.GUTENDEX_URL, title, page - 1) if page > 1 else None,
+        "results": [{"id": id, "title": title, "languages": ["en"], "download_count": 10, "authors": []} for id in ids]
+    }
 
 
 @pytest.mark.asyncio
-async def test_top_books_by_ratings(client, aioresponses):
+async def test_search_book_paginated_page_size(client, aioresponses):
+    """
+    Tests that a custom page size is assembled from the gutendex pages, and the next page is prefetched
+    """
+    title = "Sized title"
+    # 7 books in gutendex pages of 3, every gutendex page is mocked only once
+    for page in range(1, 4):
+        aioresponses.get("{}?search={}&page={}".format(Config.GUTENDEX_URL, title, page),
+                         status=200, payload=search_page_payload(title, page, count=7, page_size=3))
+
+    response = await client.get(url="/books/search-paginated/?title={}&pageSize=4".format(title))
+    assert response.status_code == 200
+    data = response.json()
+    assert data["totalCount"] == 7
+    assert data["totalPages"] == 2
+    assert data["nextPage"] == 2
+    assert [book["id"] for book in data["books"]] == [1, 2, 3, 4]
+
+    await asyncio.sleep(0.05)  # Let the prefetch of the third gutendex page finish
+    response = await client.get(url="/books/search-paginated/?title={}&pageSize=4&page=2".format(title))
+    assert response.status_code == 200
+    data = response.json()
+    assert data["totalPages"] == 2
+    assert data["nextPage"] is None
+    assert data["previousPage"] == 1
+    assert [book["id"] for book in data["books"]] == [5, 6, 7]
+
+    # The last gutendex page is short, the total pages still come from the first one
+    response = await client.get(url="/books/search-paginated/?title={}&page=3".format(title))
+    assert response.json()["totalPages"] == 3
+    assert [book["id"] for book in response.json()["books"]] == [7]
+
+
+@pytest.mark.asyncio
+async def test_search_book_paginated_validation(client, aioresponses):
+    """
+    Tests the validation of the page and the page size
+    """
+    title = "Validated title"
+    aioresponses.get("{}?search={}&page=1".format(Config.GUTENDEX_URL, title),
+                     status=200, payload=search_page_payload(title, 1, count=2, page_size=3))
+    response = await client.get(url="/books/search-paginated/?title={}&page=0".format(title))
+    assert response.status_code == 400
+    response = await client.get(url="/books/search-paginated/?title={}&pageSize={}".format(
+        title, Config.SEARCH_PAGE_MAX_SIZE + 1))
+    assert response.status_code == 400
+    response = await client.get(url="/books/search-paginated/?title={}&page=2".format(title))
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_top_books_by_ratings(client, aioresponses, monkeypatch):
     """
     Tests getting a book from the database
     """
+    # The top rated book, besides the fixture reviews
+    await client.post("/books/10/review/", content=json.dumps(ReviewCreate(rating=5, review="A review").dict()))
     ratings = {
         1: 2.5,
         2: 3,
@@ -262,8 +494,11 @@ async def test_top_books_by_ratings(client, aioresponses):
         3: 3,
         10: 1
     }
-    for id in range(1, 4):  # Prepare the mocked gutendex responses
-        payload = {
+    payload = {
+        "count": 4,
+        "next": None,
+        "previous": None,
+        "results": [{
             "id": id,
             "title": "test",
             "languages": ["en"],
@@ -273,22 +508,10 @@ async def test_top_books_by_ratings(client, aioresponses):
                 "birth_year": 1987,
                 "death_year": None
             }]
-        }
-        aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, id),
-                         status=200, payload=payload)
-
-    payload = {
-        "id": 10,
-        "title": "test",
-        "languages": ["en"],
-        "download_count": 10,
-        "authors": [{
-            "name": "author",
-            "birth_year": 1987,
-            "death_year": None
-        }]
+        } for id in [1, 2, 3, 10]]
     }
-    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 10),
+    # All the books are fetched with one `ids` request
+    aioresponses.get(re.compile(r"^{}/\?ids=.*$".format(re.escape(Config.GUTENDEX_URL))),
                      status=200, payload=payload)
 
     # Gets top 10 since amount is 10 by default
@@ -304,36 +527,18 @@ async def test_top_books_by_ratings(client, aioresponses):
     assert data[2]["rating"] == 2.5
     assert data[3]["id"] == 3
     assert data[3]["rating"] == 2
+    for book in data:
+        assert len(book["reviews"]) == reviews_lengths[book["id"]]
 
-    # Reset the mocked responses for gutendex
-    for id in range(1, 4):  # Prepare the mocked gutendex responses
-        payload = {
-            "id": id,
-            "title": "test",
-            "languages": ["en"],
-            "download_count": 10,
-            "authors": [{
-                "name": "author",
-                "birth_year": 1987,
-                "death_year": None
-            }]
-        }
-        aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, id),
-                         status=200, payload=payload)
-
-    payload = {
-        "id": 10,
-        "title": "test",
-        "languages": ["en"],
-        "download_count": 10,
-        "authors": [{
-            "name": "author",
-            "birth_year": 1987,
-            "death_year": None
-        }]
-    }
-    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 10),
-                     status=200, payload=payload)
+    # Reset the mocked responses for gutendex, the ids are fetched in concurrent chunks of one book
+    monkeypatch.setattr(Config, "GUTENDEX_IDS_CHUNK_SIZE", 1)
+    for id in [2, 10]:
+        aioresponses.get("{}/?ids={}".format(Config.GUTENDEX_URL, id), status=200, payload={
+            "count": 1,
+            "next": None,
+            "previous": None,
+            "results": [book for book in payload["results"] if book["id"] == id]
+        })
 
     response = await client.get(url="/books/top/?amount=2")
     data = response.json()
@@ -393,3 +598,432 @@ async def test_monthly_average_rating(client):
     assert data["bookId"] == 4
     monthly_avg = data["monthlyAverages"]
     assert len(monthly_avg) == 0
+
+
+@pytest.mark.asyncio
+async def test_monthly_average_rating_range(client):
+    """
+    Test monthly averages between two months
+    """
+    response = await client.get("/books/3/monthly-average/?from=2022-01&to=2022-12")
+    assert response.status_code == 200
+    monthly_avg = response.json()["monthlyAverages"]
+    assert len(monthly_avg) == 1
+    assert monthly_avg[0]["month"] == 10
+    assert monthly_avg[0]["year"] == 2022
+
+    response = await client.get("/books/3/monthly-average/?to=2021-11")
+    assert response.status_code == 200
+    monthly_avg = response.json()["monthlyAverages"]
+    assert len(monthly_avg) == 1
+    assert monthly_avg[0]["month"] == 11
+    assert monthly_avg[0]["year"] == 2021
+
+    response = await client.get("/books/3/monthly-average/?from=October")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_monthly_average_rating_after_review(client):
+    """
+    Test that the monthly averages include a review as soon as it is added
+    """
+    data = ReviewCreate(rating=4, review="A review")
+    response = await client.post("/books/11/review/", data=json.dumps(data.dict()))
+    assert response.status_code == 200
+    response = await client.get("/books/11/monthly-average/")
+    assert response.status_code == 200
+    monthly_avg = response.json()["monthlyAverages"]
+    assert len(monthly_avg) == 1
+    assert monthly_avg[0]["rating"] == 4
+
+
+@pytest.mark.asyncio
+async def test_book_reviews_paginated(client):
+    """
+    Tests paginating the reviews of a book with the cursor
+    """
+    response = await client.get("/books/3/reviews/?limit=2")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["bookId"] == 3
+    assert data["totalCount"] == 3
+    assert len(data["reviews"]) == 2
+    assert data["reviews"][0]["createdAt"] >= data["reviews"][1]["createdAt"]
+    assert data["nextCursor"] is not None
+
+    response = await client.get("/books/3/reviews/?limit=2&cursor={}".format(data["nextCursor"]))
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["reviews"]) == 1
+    assert data["reviews"][0]["rating"] == 2  # The oldest review
+    assert data["nextCursor"] is None
+
+    response = await client.get("/books/3/reviews/?cursor=invalid")
+    assert response.status_code == 400
+    response = await client.get("/books/3/reviews/?limit=0")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_book_latest_reviews(client, aioresponses, monkeypatch):
+    """
+    Tests that a book only includes the latest reviews and the total amount of them
+    """
+    monkeypatch.setattr(Config, "BOOK_REVIEWS_LIMIT", 1)
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 3), status=200, payload={
+        "id": 3,
+        "title": "test",
+        "languages": ["en"],
+        "download_count": 10,
+        "authors": []
+    })
+    response = await client.get(url="/books/3/")
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["reviews"]) == 1
+    assert data["reviewCount"] == 3
+
+
+@pytest.mark.asyncio
+async def test_get_book_latest_reviews_skip_ratings(client, aioresponses, mongoSession, monkeypatch):
+    """
+    Tests that the ratings without a review text do not take the place of the latest reviews
+    """
+    monkeypatch.setattr(Config, "BOOK_REVIEWS_LIMIT", 2)
+    db = mongoSession.client.get_default_database()
+    reviews = [{"bookId": 60, "rating": 3, "review": "Review {}".format(day) if day < 3 else None,
+                "createdAt": datetime(2022, 10, day)} for day in range(1, 6)]
+    await db.reviews.insert_many([dict(review) for review in reviews])
+    await update_book_stats(db=db, reviews=reviews)
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 60), status=200, payload={
+        "id": 60,
+        "title": "test",
+        "languages": ["en"],
+        "download_count": 10,
+        "authors": []
+    })
+    response = await client.get(url="/books/60/")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["reviews"] == ["Review 2", "Review 1"]
+    assert data["reviewCount"] == 5
+
+
+@pytest.mark.asyncio
+async def test_bulk_reviews(client, monkeypatch):
+    """
+    Tests importing many reviews at once, as a json array and as newline delimited json
+    """
+    monkeypatch.setattr(Config, "BULK_REVIEWS_BATCH_SIZE", 2)
+    reviews = [
+        {"bookId": 20, "rating": 4, "review": "Review",
+            "createdAt": "2021-05-01T10:00:00"},
+        {"bookId": 20, "rating": 10, "review": "Invalid rating"},
+        {"bookId": 20, "rating": 2},
+        {"rating": 3, "review": "Missing book"},
+        {"bookId": 21, "rating": 5, "review": "Review"},
+    ]
+    response = await client.post("/books/reviews/bulk/", content=json.dumps(reviews))
+    assert response.status_code == 200
+    data = response.json()
+    assert data["inserted"] == 3
+    assert [error["index"] for error in data["errors"]] == [1, 3]
+
+    response = await client.post("/books/reviews/bulk/",
+                                 content="\n".join(json.dumps(review) for review in reviews[:3]) + "\nnot json\n",
+                                 headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["inserted"] == 2
+    assert [error["index"] for error in data["errors"]] == [1, 3]
+
+    # The rating summaries include the imported reviews
+    response = await client.get("/books/20/reviews/")
+    assert response.json()["totalCount"] == 4
+    response = await client.get("/books/20/monthly-average/?from=2021-05&to=2021-05")
+    assert response.json()["monthlyAverages"][0]["rating"] == 4
+
+    response = await client.post("/books/reviews/bulk/", content=json.dumps({"bookId": 20}))
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_bulk_reviews_mixed_offsets(client):
+    """
+    Tests importing reviews with and without a time zone offset in the same batch
+    """
+    reviews = [
+        {"bookId": 22, "rating": 4, "createdAt": "2021-05-01T10:00:00Z"},
+        {"bookId": 22, "rating": 2, "createdAt": "2021-05-31T23:30:00-02:00"},
+        {"bookId": 22, "rating": 3, "createdAt": "2021-05-02T10:00:00"},
+        {"bookId": 22, "rating": 5},
+    ]
+    response = await client.post("/books/reviews/bulk/", content=json.dumps(reviews))
+    assert response.status_code == 200
+    assert response.json() == {"inserted": 4, "errors": []}
+    response = await client.get("/books/22/monthly-average/?from=2021-05&to=2021-06")
+    # The offsets are converted to UTC, the second review is on the first of June
+    assert [(average["month"], average["rating"]) for average in response.json()["monthlyAverages"]] == [(6, 2), (5, 3.5)]
+
+
+@pytest.mark.asyncio
+async def test_bulk_reviews_stats_failure(client, mongoSession, monkeypatch):
+    """
+    Tests that a batch whose rating summaries fail to update is undone,
+    so that a retry of the client is not counted twice, and the batches before it are kept
+    """
+    monkeypatch.setattr(Config, "BULK_REVIEWS_BATCH_SIZE", 2)
+
+    async def failing_update_book_stats(db, reviews, session=None):
+        await update_book_stats(db=db, reviews=reviews, session=session)
+        if any(review["bookId"] == 24 for review in reviews):
+            raise RuntimeError("Rollups unavailable")
+
+    monkeypatch.setattr(reviews_crud, "update_book_stats", failing_update_book_stats)
+    reviews = [
+        {"bookId": 23, "rating": 4},
+        {"bookId": 23, "rating": 2},
+        {"bookId": 23, "rating": 5},
+        {"bookId": 24, "rating": 1},
+    ]
+    response = await client.post("/books/reviews/bulk/", content=json.dumps(reviews))
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Could not add the reviews from index 2, the 2 reviews before it were added"
+    db = mongoSession.client.get_default_database()
+    assert await db.reviews.count_documents({"bookId": {"$in": [23, 24]}}) == 2
+    stats = await db.bookStats.find_one({"_id": 23})
+    assert stats["count"] == 2
+    assert stats["rating"] == 3
+    assert await db.bookStats.find_one({"_id": 24}) is None
+    assert await db.bookMonthlyStats.count_documents({"bookId": 24}) == 0
+
+
+@pytest.mark.asyncio
+async def test_split_json_array():
+    """
+    Tests that the items of a json array are split while its chunks arrive
+    """
+    body = b' [{"a": "x,]\\"}", "b": [1, {"c": 2}]}, 3, "s\\",\\"" ,{bad}] '
+
+    async def chunks(size):
+        for i in range(0, len(body), size):
+            yield body[i:i + size]
+
+    for size in [1, 2, 3, 7, len(body)]:
+        items = [item async for item in split_json_array(chunks(size))]
+        assert [item.strip() for item in items] == [
+            b'{"a": "x,]\\"}", "b": [1, {"c": 2}]}', b"3", b'"s\\",\\""', b"{bad}"]
+        assert json.loads(items[0]) == {"a": 'x,]"}', "b": [1, {"c": 2}]}
+
+    async def body_of(data):
+        yield data
+
+    assert [item async for item in split_json_array(body_of(b"[]"))] == []
+    assert [item async for item in split_json_array(body_of(b"[1,]"))] == [b"1", b""]
+    assert [item async for item in split_json_array(body_of(b'[{"a": 1}, {"b"'))] == [b'{"a": 1}', b' {"b"']
+    for invalid in [b'{"bookId": 1}', b"x[1]", b"", b"  "]:
+        with pytest.raises(HTTPException):
+            [item async for item in split_json_array(body_of(invalid))]
+
+
+@pytest.mark.asyncio
+async def test_get_books_by_ids(client, aioresponses):
+    """
+    Tests getting many books at once, in the order of the ids
+    """
+    aioresponses.get(re.compile(r"^{}/\?ids=.*$".format(re.escape(Config.GUTENDEX_URL))), status=200, payload={
+        "count": 3,
+        "next": None,
+        "previous": None,
+        "results": [{
+            "id": id,
+            "title": "test",
+            "languages": ["en"],
+            "download_count": 10,
+            "authors": []
+        } for id in [1, 3, 4]]
+    })
+    response = await client.get(url="/books/?ids=3,1,4,999")
+    assert response.status_code == 200
+    data = response.json()
+    # 999 is not known to gutendex
+    assert [book["id"] for book in data] == [3, 1, 4]
+    assert data[0]["rating"] == 2
+    assert data[0]["reviewCount"] == 3
+    assert len(data[0]["reviews"]) == 3
+    assert data[1]["rating"] == 2.5
+    assert data[2]["rating"] is None
+    assert data[2]["reviews"] is None
+
+    response = await client.get(url="/books/?ids=1,a")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_book_gutendex_deadline(client, monkeypatch):
+    """
+    Tests that a book is returned with its ratings only when gutendex misses the deadline
+    """
+    async def slow_book_data(bookId, aiohttpSession):
+        await asyncio.sleep(0.2)
+
+    monkeypatch.setattr(books_crud, "get_book_data", slow_book_data)
+    monkeypatch.setattr(Config, "GUTENDEX_DEADLINE", 0.05)
+    response = await client.get(url="/books/1/")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["id"] == 1
+    assert data["partial"] is True
+    assert data["rating"] == 2.5
+    assert data["reviewCount"] == 2
+    assert "title" not in data
+    await asyncio.sleep(0.2)  # Let the background gutendex request finish
+
+
+@pytest.mark.asyncio
+async def test_get_book_stale_when_gutendex_unavailable(client, aioresponses, monkeypatch):
+    """
+    Tests that an expired cached book is served when gutendex is unavailable
+    """
+    await book_cache.set(7, {
+        "id": 7,
+        "title": "Cached",
+        "languages": ["en"],
+        "download_count": 10,
+        "authors": []
+    })
+    now = time.monotonic()
+    # Past the stale-while-revalidate window
+    monkeypatch.setattr(time, "monotonic", lambda: now +
+                        Config.BOOK_CACHE_TTL + Config.BOOK_CACHE_MAX_STALE + 1)
+    monkeypatch.setattr(gutendex_client, "backoff_base", 0)
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 7), status=503)
+    response = await client.get(url="/books/7/")
+    assert response.status_code == 200
+    assert response.json()["title"] == "Cached"
+
+
+@pytest.mark.asyncio
+async def test_get_book_stale_while_revalidate(client, aioresponses, monkeypatch):
+    """
+    Tests that a recently expired cached book is served right away and refreshed once in the background
+    """
+    book = {"id": 7, "title": "Old", "languages": ["en"], "download_count": 10, "authors": []}
+    monkeypatch.setattr(book_cache.local, "ttl", -1)  # Expired a second ago
+    await book_cache.set(7, book)
+    monkeypatch.undo()
+    # The refresh is held until the concurrent requests are answered, whatever order
+    # the middlewares let them run in
+    refresh = asyncio.Event()
+
+    async def held_refresh(url, **kwargs):
+        await refresh.wait()
+
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 7),
+                     status=200, payload=dict(book, title="New"), callback=held_refresh)
+    responses = await asyncio.gather(*[client.get(url="/books/7/") for _ in range(3)])
+    assert [response.json()["title"] for response in responses] == ["Old"] * 3
+    refresh.set()
+    await asyncio.sleep(0.05)  # Let the background refresh finish
+    response = await client.get(url="/books/7/")
+    assert response.json()["title"] == "New"
+    # Refreshed by one gutendex request only
+    assert sum(len(calls) for calls in aioresponses.requests.values()) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_book_etag(client, aioresponses):
+    """
+    Tests that a book is not modified until a review is added to it
+    """
+    payload = {"id": 31, "title": "test", "languages": ["en"], "download_count": 10, "authors": []}
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 31),
+                     status=200, payload=payload)
+    await client.post("/books/31/review/", data=json.dumps(ReviewCreate(rating=4, review="A review").dict()))
+    response = await client.get(url="/books/31/")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age={}".format(Config.BOOK_MAX_AGE)
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    # Answered without looking for the book data
+    hits = book_cache.local.hits
+    response = await client.get(url="/books/31/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    response = await client.get(url="/books/31/", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    assert book_cache.local.hits == hits
+
+    await client.post("/books/31/review/", data=json.dumps(ReviewCreate(rating=2, review="Another review").dict()))
+    response = await client.get(url="/books/31/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["reviewCount"] == 2
+
+
+@pytest.mark.asyncio
+async def test_get_book_last_modified_backdated_review(client, aioresponses, mongoSession, monkeypatch):
+    """
+    Tests that importing a review with a past createdAt moves Last-Modified,
+    and that the rating summary is read once per request
+    """
+    payload = {"id": 2, "title": "test", "languages": ["en"], "download_count": 10, "authors": []}
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 2), status=200, payload=payload, repeat=True)
+    # After the latest review of the book (2022-10-02), but before the import
+    since = "Wed, 05 Oct 2022 00:00:00 GMT"
+    response = await client.post("/books/reviews/bulk/", content=json.dumps(
+        [{"bookId": 2, "rating": 1, "createdAt": "2020-01-01T00:00:00"}]))
+    assert response.json()["inserted"] == 1
+
+    db = mongoSession.client.get_default_database()
+    find_one = type(db.bookStats).find_one
+    reads = []
+
+    def counting_find_one(self, *args, **kwargs):
+        if self.name == "bookStats":
+            reads.append(args)
+        return find_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(db.bookStats), "find_one", counting_find_one)
+    response = await client.get(url="/books/2/", headers={"If-Modified-Since": since})
+    assert response.status_code == 200
+    assert response.json()["reviewCount"] == 2
+    assert len(reads) == 1
+
+
+@pytest.mark.asyncio
+async def test_top_books_etag(client, aioresponses):
+    """
+    Tests that the top books are not modified while their content is the same
+    """
+    await client.post("/books/10/review/", content=json.dumps(ReviewCreate(rating=5, review="A review").dict()))
+    aioresponses.get(re.compile(r"^{}/\?ids=.*$".format(re.escape(Config.GUTENDEX_URL))), status=200, payload={
+        "count": 1,
+        "next": None,
+        "previous": None,
+        "results": [{"id": 10, "title": "test", "languages": ["en"], "download_count": 10, "authors": []}]
+    })
+    response = await client.get(url="/books/top/?amount=1")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age={}".format(Config.TOP_BOOKS_MAX_AGE)
+    etag = response.headers["etag"]
+    response = await client.get(url="/books/top/?amount=1", headers={"If-None-Match": "\"other\", {}".format(etag)})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+@pytest.mark.asyncio
+async def test_monthly_average_rating_etag(client):
+    """
+    Tests that the monthly averages of a book are not modified while its reviews are the same
+    """
+    response = await client.get("/books/1/monthly-average/")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    response = await client.get("/books/1/monthly-average/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    # Another range is another response
+    response = await client.get("/books/1/monthly-average/?from=2020-01", headers={"If-None-Match": etag})
+    assert response.status_code == 200
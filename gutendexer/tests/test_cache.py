@@ -0,0 +1,100 @@
+import asyncio
+import time
+import pytest
+from ..cache import BookCache, LRUCache, MongoCache, SearchCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """
+    Tests that the cache keeps at most max_size entries, evicting the least recently used
+    """
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set(1, "one")
+    cache.set(2, "two")
+    assert cache.get(1) == "one"  # 2 becomes the least recently used
+    cache.set(3, "three")
+    assert cache.get(2) is None
+    assert cache.get(1) == "one"
+    assert cache.get(3) == "three"
+    assert cache.stats() == {"hits": 3, "misses": 1, "staleHits": 0, "size": 2}
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    """
+    Tests that the entries are not returned after their time to live
+    """
+    cache = LRUCache(max_size=2, ttl=10)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set(1, "one")
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get(1) is None
+    # Still kept to be served stale
+    assert cache.get_stale(1) == "one"
+    assert cache.get_stale(1, max_stale=5) == "one"
+    assert cache.get_stale(1, max_stale=0.5) is None
+
+
+@pytest.mark.asyncio
+async def test_book_cache_get_many():
+    """
+    Tests getting many books from the book cache
+    """
+    cache = BookCache(local=LRUCache(max_size=10, ttl=60))
+    await cache.set_many({1: {"id": 1}, 2: {"id": 2}})
+    assert await cache.get_many([1, 2, 3]) == {1: {"id": 1}, 2: {"id": 2}}
+    assert await cache.get(3) is None
+    assert cache.stats() == {"local": {"hits": 2, "misses": 2, "staleHits": 0, "size": 2}}
+
+
+@pytest.mark.asyncio
+async def test_mongo_cache_set_many(mongoSession):
+    """
+    Tests that the shared cache stores and replaces many entries at once
+    """
+    cache = MongoCache(collection_name="testCache", ttl=60)
+    try:
+        await cache.set_many({1: {"id": 1}, 2: {"id": 2}})
+        await cache.set_many({2: {"id": 2, "title": "New"}})
+        await cache.set_many({})
+        assert await cache.get_many([1, 2, 3]) == {1: {"id": 1}, 2: {"id": 2, "title": "New"}}
+        assert cache.stats() == {"hits": 2, "misses": 1}
+    finally:
+        await cache.clear()
+
+
+def test_lru_cache_bounds_bytes():
+    """
+    Tests that the cache evicts entries when their total size is over max_bytes
+    """
+    cache = LRUCache(max_size=10, ttl=60, max_bytes=100)
+    cache.set(1, "one", size=60)
+    cache.set(2, "two", size=30)
+    cache.set(3, "three", size=30)
+    assert cache.get(1) is None
+    assert cache.bytes == 60
+    cache.set(2, "two", size=10)  # Replacing an entry replaces its size
+    assert cache.bytes == 40
+
+
+@pytest.mark.asyncio
+async def test_search_cache_coalesces_requests():
+    """
+    Tests that concurrent fetches of the same search share one call and get cached
+    """
+    cache = SearchCache(cache=LRUCache(max_size=10, ttl=60))
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"count": 1}, 10
+
+    key = SearchCache.key(search="  A  Title ", page=1)
+    assert key == ("a title", 1)
+    results = await asyncio.gather(*[cache.get_or_fetch(key, fetch) for _ in range(5)])
+    assert results == [{"count": 1}] * 5
+    assert len(calls) == 1
+    assert len(cache.flights) == 0
+    assert await cache.get_or_fetch(key, fetch) == {"count": 1}
+    assert len(calls) == 1
@@ -0,0 +1,84 @@
+import pytest
+from ..Config import Config
+from ..catalog import TitleIndex, catalog, catalog_collection, ingest, load_dump, parse_csv_authors
+from ..crud.utils import TitleMatcher
+
+TITLES = [
+    "Pride and Prejudice",
+    "The Adventures of Sherlock Holmes",
+    "Other Worlds",
+    "Alice's Adventures in Wonderland",
+    "A Tale of Two Cities",
+    "Café Society",
+]
+
+
+def test_title_index_matches_title_matcher():
+    """
+    Tests that the title index returns exactly the titles that the title matcher accepts
+    """
+    index = TitleIndex()
+    index.build([{"id": id, "title": title, "download_count": id}
+                for id, title in enumerate(TITLES)])
+    for search in ["the", "adventures", "Adventures of", "th", "o", "a tale", "prejudice pride", "missing", "café", "CAFE"]:
+        expected = [id for id, title in enumerate(TITLES) if TitleMatcher(search).match(title)]
+        # Most downloaded first
+        assert index.search(search) == sorted(expected, reverse=True)
+
+
+def test_parse_csv_authors():
+    assert parse_csv_authors("Austen, Jane, 1775-1817; Doe, John") == [
+        {"name": "Austen, Jane", "birth_year": 1775, "death_year": 1817},
+        {"name": "Doe, John", "birth_year": None, "death_year": None}
+    ]
+
+
+def test_load_csv_dump(tmp_path):
+    path = tmp_path / "pg_catalog.csv"
+    path.write_text(
+        "Text#,Type,Issued,Title,Language,Authors,Subjects,LoCC,Bookshelves\n"
+        "1342,Text,1998-06-01,Pride and Prejudice,en,\"Austen, Jane, 1775-1817\",,,\n"
+        "10802,Sound,2004-01-01,An audio book,en,,,,\n")
+    books = list(load_dump(str(path)))
+    assert len(books) == 1
+    assert books[0]["id"] == 1342
+    assert books[0]["title"] == "Pride and Prejudice"
+    assert books[0]["languages"] == ["en"]
+    assert books[0]["authors"][0]["name"] == "Austen, Jane"
+
+
+@pytest.mark.asyncio
+async def test_search_local_catalog(client, monkeypatch):
+    """
+    Tests searching the titles in the local catalog, with exact pagination
+    """
+    await ingest([{
+        "id": id,
+        "title": title,
+        "authors": [],
+        "languages": ["en"],
+        "download_count": id
+    } for id, title in enumerate(TITLES)])
+    await catalog.load()
+    monkeypatch.setattr(Config, "LOCAL_CATALOG", True)
+    monkeypatch.setattr(Config, "CATALOG_PAGE_SIZE", 1)
+    try:
+        response = await client.get(url="/books/search-paginated/?title=the&page=2")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["totalCount"] == 2
+        assert data["totalPages"] == 2
+        assert data["nextPage"] is None
+        assert data["previousPage"] == 1
+        assert [book["id"] for book in data["books"]] == [1]
+
+        response = await client.get(url="/books/search-paginated/?title=the&page=3")
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Page index should be at most 2"
+
+        response = await client.get(url="/books/search/?title=adventures")
+        assert response.status_code == 200
+        assert [book["id"] for book in response.json()] == [3, 1]
+    finally:
+        await catalog_collection().delete_many({})
+        catalog.index = None
@@ -0,0 +1,30 @@
+import pytest
+from ..Config import Config
+from ..clients import HttpSessionRegistry, MongoClientRegistry
+
+
+def test_mongo_registry_reuses_client():
+    """
+    Tests that the registry hands out the same pooled client until it is closed
+    """
+    registry = MongoClientRegistry()
+    client = registry.connect()
+    assert registry.client is client
+    registry.close()
+    assert registry._client is None
+    assert registry.client is not client
+    registry.close()
+
+
+@pytest.mark.asyncio
+async def test_http_registry_reuses_session():
+    """
+    Tests that the registry hands out the same aiohttp session until it is closed
+    """
+    registry = HttpSessionRegistry()
+    session = registry.connect()
+    assert registry.session is session
+    assert session.connector.limit_per_host == Config.GUTENDEX_CONNECTION_LIMIT_PER_HOST
+    await registry.close()
+    assert session.closed
+    assert registry._session is None
@@ -0,0 +1,203 @@
+import asyncio
+import time
+import aiohttp
+import pytest
+from ..gutendex import CircuitBreaker, CircuitOpenError, GutendexClient, GutendexError, GutendexUnavailable
+
+URL = "http://gutendex.test/books/1"
+
+
+def make_client(**kwargs) -> GutendexClient:
+    options = {
+        "retries": 2,
+        "backoff_base": 0,
+        "backoff_max": 0,
+        "breaker": CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    }
+    options.update(kwargs)
+    return GutendexClient(**options)
+
+
+@pytest.mark.asyncio
+async def test_retries_unavailable_gutendex(aioresponses):
+    """
+    Tests that the failures of gutendex are retried
+    """
+    aioresponses.get(URL, status=503)
+    aioresponses.get(URL, status=200, payload={"id": 1})
+    client = make_client()
+    async with aiohttp.ClientSession() as session:
+        data, size = await client.get_json(url=URL, aiohttpSession=session)
+    assert data == {"id": 1}
+    assert size > 0
+
+
+@pytest.mark.asyncio
+async def test_does_not_retry_gutendex_errors(aioresponses):
+    """
+    Tests that an error answered by gutendex is not retried
+    """
+    aioresponses.get(URL, status=404, payload={"detail": "Not found."})
+    client = make_client()
+    async with aiohttp.ClientSession() as session:
+        with pytest.raises(GutendexError) as e:
+            await client.get_json(url=URL, aiohttpSession=session)
+    assert not isinstance(e.value, GutendexUnavailable)
+    assert e.value.detail == "Not found."
+    assert client.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens(aioresponses, monkeypatch):
+    """
+    Tests that the circuit opens after consecutive failures and lets a trial call through later
+    """
+    client = make_client(retries=0)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            aioresponses.get(URL, status=500)
+            with pytest.raises(GutendexUnavailable):
+                await client.get_json(url=URL, aiohttpSession=session)
+        assert client.breaker.state == "open"
+        # Fast fails without calling gutendex
+        with pytest.raises(CircuitOpenError):
+            await client.get_json(url=URL, aiohttpSession=session)
+
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + 31)
+        assert client.breaker.state == "half-open"
+        aioresponses.get(URL, status=200, payload={"id": 1})
+        data, _ = await client.get_json(url=URL, aiohttpSession=session)
+        assert data == {"id": 1}
+        assert client.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_invalid_json_trial_reopens_circuit(aioresponses, monkeypatch):
+    """
+    Tests that a response that is not json counts as a failure, also for the trial call
+    """
+    client = make_client(retries=0)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            aioresponses.get(URL, status=200, body="<html>Maintenance</html>")
+            with pytest.raises(GutendexUnavailable):
+                await client.get_json(url=URL, aiohttpSession=session)
+        assert client.breaker.state == "open"
+
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + 31)
+        aioresponses.get(URL, status=200, body="<html>Maintenance</html>")
+        with pytest.raises(GutendexUnavailable):
+            await client.get_json(url=URL, aiohttpSession=session)
+        assert client.breaker.state == "open"
+
+        monkeypatch.setattr(time, "monotonic", lambda: now + 62)
+        aioresponses.get(URL, status=200, payload={"id": 1})
+        data, _ = await client.get_json(url=URL, aiohttpSession=session)
+        assert data == {"id": 1}
+        assert client.breaker.state == "closed"
+
+
+class SlowResponse(object):
+    def __init__(self, delay: float, body: bytes):
+        self.delay = delay
+        self.body = body
+        self.status = 200
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.delay)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return self.body
+
+
+class SlowSession(object):
+    """
+    Answers the first request after one second and the rest right away
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            return SlowResponse(1, b'{"id": 1, "hedged": false}')
+        return SlowResponse(0, b'{"id": 1, "hedged": true}')
+
+
+@pytest.mark.asyncio
+async def test_hedged_request():
+    """
+    Tests that a slow request is hedged with a second one and the fastest answer is used
+    """
+    client = make_client(hedge_delay=0.01)
+    session = SlowSession()
+    data, _ = await client.get_json(url=URL, aiohttpSession=session)
+    assert data == {"id": 1, "hedged": True}
+    assert session.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial():
+    """
+    Tests that a cancelled trial call lets the next call through as the trial
+    """
+    client = make_client()
+    client.breaker.opened_at = time.monotonic() - 31
+    assert client.breaker.state == "half-open"
+    session = SlowSession()
+    trial = asyncio.ensure_future(client.get_json(url=URL, aiohttpSession=session))
+    await asyncio.sleep(0.01)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    data, _ = await client.get_json(url=URL, aiohttpSession=session)
+    assert data == {"id": 1, "hedged": True}
+    assert client.breaker.state == "closed"
+
+
+
+class HangingSession(object):
+    """
+    Never answers, and records the requests that were cancelled
+    """
+
+    def __init__(self):
+        self.cancelled = 0
+
+    def get(self, url, **kwargs):
+        session = self
+
+        class HangingResponse(object):
+            async def __aenter__(self):
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    session.cancelled += 1
+                    raise
+
+            async def __aexit__(self, *args):
+                pass
+        return HangingResponse()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_hedged_request():
+    """
+    Tests that the request is cancelled with the call, also before it is hedged
+    """
+    client = make_client(hedge_delay=5)
+    session = HangingSession()
+    call = asyncio.ensure_future(client.get_json(url=URL, aiohttpSession=session))
+    await asyncio.sleep(0.01)
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+    await asyncio.sleep(0.01)
+    assert session.cancelled == 1
@@ -0,0 +1,56 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING
+from ..crud.utils import get_book_monthly_average_query, get_book_reviews_query
+from ..indexes import ensure_indexes, missing_indexes, rebuild_indexes
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes(mongoSession):
+    """
+    Tests that the required indexes are created and can be rebuilt
+    """
+    db = mongoSession.client.get_default_database()
+    await ensure_indexes(db)
+    assert await missing_indexes(db) == {}
+    await rebuild_indexes(db)
+    assert await missing_indexes(db) == {}
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_drops_superseded(mongoSession):
+    """
+    Tests that the index that bookId_createdAt_id replaced is dropped
+    """
+    db = mongoSession.client.get_default_database()
+    await db.reviews.create_index([("bookId", ASCENDING), ("createdAt", DESCENDING)], name="bookId_createdAt")
+    await ensure_indexes(db)
+    existing = await db.reviews.index_information()
+    assert "bookId_createdAt" not in existing
+    assert "bookId_createdAt_id" in existing
+
+
+@pytest.mark.asyncio
+async def test_latest_reviews_use_index(mongoSession):
+    """
+    Tests that the latest reviews of a book scan the bookId index instead of the whole collection
+    """
+    db = mongoSession.client.get_default_database()
+    await ensure_indexes(db)
+    explain = await db.reviews.find(**get_book_reviews_query(bookId=1, limit=10)).explain()
+    assert "IXSCAN" in str(explain)
+    assert "COLLSCAN" not in str(explain)
+    # The index gives the order, there is no in-memory sort
+    assert "'SORT'" not in str(explain)
+
+
+@pytest.mark.asyncio
+async def test_monthly_rollups_use_index(mongoSession):
+    """
+    Tests that reading the monthly rollups of a book in a range scans the rollup index
+    """
+    db = mongoSession.client.get_default_database()
+    await ensure_indexes(db)
+    query = get_book_monthly_average_query(bookId=3, fromPeriod=202101, toPeriod=202212)
+    explain = await db.bookMonthlyStats.find(**query).explain()
+    assert "IXSCAN" in str(explain)
+    assert "COLLSCAN" not in str(explain)
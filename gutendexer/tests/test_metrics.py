@@ -0,0 +1,67 @@
+import pytest
+from ..Config import Config
+from ..metrics import Counter, Histogram, current_route, stage, stage_duration
+
+
+def test_histogram_render():
+    """
+    Tests that a histogram is rendered with cumulative buckets, its sum and count
+    """
+    histogram = Histogram("duration_seconds", "A duration", ["route"], buckets=[0.1, 1])
+    histogram.observe(0.05, route="/a")
+    histogram.observe(0.5, route="/a")
+    histogram.observe(5, route="/a")
+    assert histogram.render().split("\n") == [
+        "# HELP duration_seconds A duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{route="/a",le="0.1"} 1',
+        'duration_seconds_bucket{route="/a",le="1"} 2',
+        'duration_seconds_bucket{route="/a",le="+Inf"} 3',
+        'duration_seconds_sum{route="/a"} 5.55',
+        'duration_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_counter_render():
+    counter = Counter("errors_total", "Errors", ["kind"])
+    counter.inc(kind='say "hi"')
+    counter.inc(kind='say "hi"')
+    assert counter.render().split("\n")[-1] == 'errors_total{kind="say \\"hi\\""} 2'
+
+
+def test_stage():
+    """
+    Tests that the stages are timed with the route of the request and their status
+    """
+    token = current_route.set("/test/")
+    try:
+        with stage("work"):
+            pass
+        with pytest.raises(ValueError):
+            with stage("work"):
+                raise ValueError()
+    finally:
+        current_route.reset(token)
+    assert stage_duration.values[("/test/", "work", "ok")][-1] == 1
+    assert stage_duration.values[("/test/", "work", "error")][-1] == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, aioresponses):
+    """
+    Tests that the requests and their stages are exported at /metrics by route
+    """
+    aioresponses.get("{}/{}".format(Config.GUTENDEX_URL, 404), status=404, payload={"detail": "Not found."})
+    await client.get(url="/books/404/")
+    response = await client.get(url="/metrics")
+    assert response.status_code == 200
+    lines = response.text.split("\n")
+    assert any(line.startswith('http_request_duration_seconds_count{method="GET",route="/books/{bookId}/",status="500"}')
+               for line in lines)
+    assert any(line.startswith('stage_duration_seconds_count{route="/books/{bookId}/",stage="gutendex",status="error"}')
+               for line in lines)
+    assert any(line.startswith('stage_duration_seconds_count{route="/books/{bookId}/",stage="mongo.find",status="ok"}')
+               for line in lines)
+    assert any(line.startswith('gutendex_errors_total{kind="404"}') for line in lines)
+    assert any(line.startswith('cache_hit_ratio{cache="books"}') for line in lines)
+    assert any(line.startswith('mongo_pool_connections{state="max"}') for line in lines)
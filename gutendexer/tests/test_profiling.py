@@ -0,0 +1,123 @@
+import logging
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+from ..Config import Config
+from .. import profiling
+from ..profiling import check_slow_aggregation, profile_requests
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/work/")
+    async def work():
+        return {"total": sum(range(1000))}
+
+    app.middleware("http")(profile_requests)
+    return app
+
+
+@pytest.fixture
+def profiling_enabled(monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, "PROFILING", True)
+    monkeypatch.setattr(Config, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(Config, "PROFILE_SECRET", "secret")
+    # Use cProfile, whether pyinstrument is installed or not
+    monkeypatch.setattr(profiling, "pyinstrument", None)
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_profile_with_header(profiling_enabled):
+    """
+    Tests that the profile is returned instead of the response when asked with the header
+    """
+    async with AsyncClient(app=make_app(), base_url="http://testserver") as client:
+        response = await client.get("/work/", headers={Config.PROFILE_HEADER: "secret"})
+        assert response.status_code == 200
+        assert "function calls" in response.text
+        response = await client.get("/work/")
+        assert response.json() == {"total": 499500}
+    assert list(profiling_enabled.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_profile_header_needs_secret(profiling_enabled, monkeypatch):
+    """
+    Tests that the profile is only returned when the header has the secret,
+    and never while the secret is not configured
+    """
+    async with AsyncClient(app=make_app(), base_url="http://testserver") as client:
+        response = await client.get("/work/", headers={Config.PROFILE_HEADER: "guess"})
+        assert response.json() == {"total": 499500}
+        monkeypatch.setattr(Config, "PROFILE_SECRET", None)
+        response = await client.get("/work/", headers={Config.PROFILE_HEADER: "secret"})
+        assert response.json() == {"total": 499500}
+
+
+@pytest.mark.asyncio
+async def test_profile_with_header_while_profiling(profiling_enabled, monkeypatch):
+    """
+    Tests that a profile asked while another request is profiled is answered with 409
+    """
+    monkeypatch.setattr(profiling, "_profiling", True)
+    async with AsyncClient(app=make_app(), base_url="http://testserver") as client:
+        response = await client.get("/work/", headers={Config.PROFILE_HEADER: "secret"})
+        assert response.status_code == 409
+        response = await client.get("/work/")
+        assert response.json() == {"total": 499500}
+
+
+@pytest.mark.asyncio
+async def test_profile_sampled(profiling_enabled, monkeypatch):
+    """
+    Tests that the sampled requests are answered normally and their profiles are stored
+    """
+    monkeypatch.setattr(Config, "PROFILE_SAMPLE_RATE", 1)
+    async with AsyncClient(app=make_app(), base_url="http://testserver") as client:
+        response = await client.get("/work/")
+    assert response.json() == {"total": 499500}
+    profiles = list(profiling_enabled.iterdir())
+    assert len(profiles) == 1
+    assert profiles[0].name.endswith("-GET-work.txt")
+
+
+@pytest.mark.asyncio
+async def test_profiling_disabled(monkeypatch):
+    monkeypatch.setattr(Config, "PROFILING", False)
+    monkeypatch.setattr(Config, "PROFILE_SECRET", "secret")
+    async with AsyncClient(app=make_app(), base_url="http://testserver") as client:
+        response = await client.get("/work/", headers={Config.PROFILE_HEADER: "secret"})
+    assert response.json() == {"total": 499500}
+
+
+class ExplainedDatabase(object):
+    async def command(self, command, spec, verbosity):
+        return {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}, "verbosity": verbosity}
+
+
+class ExplainedCollection(object):
+    name = "bookStats"
+    database = ExplainedDatabase()
+
+
+@pytest.mark.asyncio
+async def test_slow_aggregation_logged(monkeypatch, caplog):
+    """
+    Tests that only the aggregations slower than SLOW_QUERY_MS are logged, with their explain output
+    """
+    monkeypatch.setattr(Config, "SLOW_QUERY_MS", 100)
+    pipeline = [{"$match": {"bookId": 1}}]
+    assert check_slow_aggregation(ExplainedCollection(), pipeline, duration=0.05) is None
+    with caplog.at_level(logging.WARNING, logger="gutendexer.profiling.slow_queries"):
+        task = check_slow_aggregation(ExplainedCollection(), pipeline, duration=0.2)
+        # Kept referenced until it ends
+        assert task in profiling._slow_query_tasks
+        await task
+    assert task not in profiling._slow_query_tasks
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert "bookStats took 200.0ms" in message
+    assert '"$match"' in message
+    assert "IXSCAN" in message
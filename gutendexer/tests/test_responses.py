@@ -0,0 +1,29 @@
+import json
+import pytest
+from fastapi.encoders import jsonable_encoder
+from ..routes import responses
+from ..routes.responses import FastJSONResponse, dumps
+from ..schemas.book import Author, BookBase
+
+
+BOOKS = [BookBase(id=id, title="Título {}".format(id), languages=["en"], download_count=id,
+                  authors=[Author(name="author", birth_year=1987)]) for id in range(3)]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_books(monkeypatch, use_orjson):
+    """
+    Tests that the books are serialized like FastAPI does, with or without orjson
+    """
+    if not use_orjson:
+        monkeypatch.setattr(responses, "orjson", None)
+    assert json.loads(dumps(BOOKS)) == jsonable_encoder(BOOKS)
+
+
+def test_fast_json_response():
+    """
+    Tests that the response body is the serialized content
+    """
+    response = FastJSONResponse(BOOKS)
+    assert response.media_type == "application/json"
+    assert json.loads(response.body) == jsonable_encoder(BOOKS)
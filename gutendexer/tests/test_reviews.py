@@ -0,0 +1,127 @@
+import asyncio
+import json
+import pytest
+from datetime import datetime
+from ..Config import Config
+from ..crud import reviews as reviews_crud
+from ..crud.reviews import ReviewBufferStopped, ReviewWriteBuffer, review_buffer
+from ..crud.stats import rebuild_book_stats, update_book_stats
+from ..schemas.review import ReviewCreate
+
+
+@pytest.mark.asyncio
+async def test_review_buffer_flushes_on_stop(mongoSession):
+    """
+    Tests that the buffer rejects reviews when full and writes the queued ones on stop
+    """
+    db = mongoSession.client.get_default_database()
+    buffer = ReviewWriteBuffer(max_size=2, batch_size=10, flush_interval=60)
+    for rating in [1, 3]:
+        buffer.put({"bookId": 30, "rating": rating,
+                   "review": None, "createdAt": datetime.now()})
+    with pytest.raises(asyncio.QueueFull):
+        buffer.put({"bookId": 30, "rating": 5,
+                   "review": None, "createdAt": datetime.now()})
+    try:
+        await buffer.stop()
+        assert buffer.qsize() == 0
+        assert await db.reviews.count_documents({"bookId": 30}) == 2
+        stats = await db.bookStats.find_one({"_id": 30})
+        assert stats["rating"] == 2
+    finally:
+        await db.reviews.delete_many({"bookId": 30})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_review_buffer_keeps_order(mongoSession):
+    """
+    Tests that the buffered reviews are written in the order they were queued,
+    and that the buffer rejects reviews once it is stopped
+    """
+    db = mongoSession.client.get_default_database()
+    buffer = ReviewWriteBuffer(max_size=10, batch_size=2, flush_interval=60)
+    buffer.put({"bookId": 33, "rating": 1, "review": None, "createdAt": datetime.now()})
+    # Let the background task take the first review and wait for a full batch
+    await asyncio.sleep(0.01)
+    for rating in [2, 3]:
+        buffer.put({"bookId": 33, "rating": rating, "review": None, "createdAt": datetime.now()})
+    try:
+        await buffer.stop()
+        assert [review["rating"] async for review in db.reviews.find(
+            {"bookId": 33}).sort("_id", 1)] == [1, 2, 3]
+        with pytest.raises(ReviewBufferStopped):
+            buffer.put({"bookId": 33, "rating": 4, "review": None, "createdAt": datetime.now()})
+        assert buffer.qsize() == 0
+    finally:
+        await db.reviews.delete_many({"bookId": 33})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_review_buffer_stats_failure(mongoSession, monkeypatch):
+    """
+    Tests that the acknowledged reviews of a batch whose rating summaries fail to update
+    are kept and counted in the summaries
+    """
+    db = mongoSession.client.get_default_database()
+
+    async def failing_update_book_stats(db, reviews, session=None):
+        # Only the first review is counted
+        await update_book_stats(db=db, reviews=reviews[:1], session=session)
+        raise RuntimeError("Summaries unavailable")
+
+    monkeypatch.setattr(reviews_crud, "update_book_stats", failing_update_book_stats)
+    buffer = ReviewWriteBuffer(max_size=10, batch_size=10, flush_interval=60)
+    for rating in [2, 4]:
+        buffer.put({"bookId": 34, "rating": rating, "review": None, "createdAt": datetime(2022, 3, 1)})
+    try:
+        await buffer.stop()
+        assert await db.reviews.count_documents({"bookId": 34}) == 2
+        stats = await db.bookStats.find_one({"_id": 34})
+        assert stats["count"] == 2
+        assert stats["rating"] == 3
+        assert await db.bookMonthlyStats.count_documents({"bookId": 34}) == 1
+    finally:
+        await db.reviews.delete_many({"bookId": 34})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_review_buffer_flushes_full_batch(mongoSession):
+    """
+    Tests that a full batch is written without waiting for the flush interval
+    """
+    db = mongoSession.client.get_default_database()
+    buffer = ReviewWriteBuffer(max_size=10, batch_size=2, flush_interval=60)
+    for rating in [1, 3]:
+        buffer.put({"bookId": 31, "rating": rating,
+                   "review": None, "createdAt": datetime.now()})
+    try:
+        for _ in range(100):
+            if await db.reviews.count_documents({"bookId": 31}) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert await db.reviews.count_documents({"bookId": 31}) == 2
+    finally:
+        await buffer.stop()
+        await db.reviews.delete_many({"bookId": 31})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_add_review_write_behind(client, mongoSession, monkeypatch):
+    """
+    Tests that with write-behind a review is acknowledged and written later
+    """
+    db = mongoSession.client.get_default_database()
+    monkeypatch.setattr(Config, "REVIEW_WRITE_BEHIND", True)
+    data = ReviewCreate(rating=5, review="A review")
+    try:
+        response = await client.post("/books/32/review/", content=json.dumps(data.dict()))
+        assert response.status_code == 200
+        await review_buffer.stop()
+        assert await db.reviews.count_documents({"bookId": 32}) == 1
+    finally:
+        await db.reviews.delete_many({"bookId": 32})
+        await rebuild_book_stats(db)
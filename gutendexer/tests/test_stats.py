@@ -0,0 +1,100 @@
+import pytest
+from datetime import datetime
+from ..crud import utils
+from ..crud.stats import rebuild_book_stats, recompute_book_stats, update_book_stats
+from ..crud.utils import get_book_monthly_stats_pipeline, get_book_stats_pipeline
+
+
+@pytest.mark.asyncio
+async def test_book_stats_incremental_matches_rebuild(mongoSession):
+    """
+    Tests that the incrementally updated rating summary equals the rebuilt one
+    """
+    db = mongoSession.client.get_default_database()
+    reviews = [
+        {"bookId": 50, "rating": 4, "review": "Review",
+            "createdAt": datetime(2022, 10, 1)},
+        {"bookId": 50, "rating": 1, "review": "Review",
+            "createdAt": datetime(2022, 11, 1)},
+        {"bookId": 51, "rating": 3, "review": "Review",
+            "createdAt": datetime(2022, 9, 1)},
+    ]
+    await db.reviews.insert_many([dict(review) for review in reviews])
+    try:
+        await update_book_stats(db=db, reviews=reviews[:1])
+        await update_book_stats(db=db, reviews=reviews[1:])
+        incremental = await db.bookStats.find_one({"_id": 50})
+        assert incremental["count"] == 2
+        assert incremental["sum"] == 5
+        assert incremental["rating"] == 2.5
+        assert incremental["lastReviewAt"] == datetime(2022, 11, 1)
+
+        await rebuild_book_stats(db)
+        rebuilt = await db.bookStats.find_one({"_id": 50})
+        for field in ["bookId", "count", "sum", "rating", "lastReviewAt"]:
+            assert rebuilt[field] == incremental[field]
+    finally:
+        await db.reviews.delete_many({"bookId": {"$in": [50, 51]}})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_existing_reviews_need_rebuild(mongoSession):
+    """
+    Tests that reviews that existed before the rating summaries, e.g. inserted directly,
+    are not counted until the summaries are rebuilt (the rebuild-stats command)
+    """
+    db = mongoSession.client.get_default_database()
+    await db.reviews.insert_one({"bookId": 52, "rating": 5, "review": "Review",
+                                 "createdAt": datetime(2022, 10, 1)})
+    try:
+        assert await db.bookStats.find_one({"_id": 52}) is None
+        await rebuild_book_stats(db)
+        stats = await db.bookStats.find_one({"_id": 52})
+        assert stats["count"] == 1
+        assert stats["rating"] == 5
+        assert await db.bookMonthlyStats.count_documents({"bookId": 52}) == 1
+    finally:
+        await db.reviews.delete_many({"bookId": 52})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_recompute_book_stats(mongoSession):
+    """
+    Tests that recomputing the summaries of a book repairs an update that was applied
+    without its review, and removes the summaries of a book without reviews
+    """
+    db = mongoSession.client.get_default_database()
+    review = {"bookId": 53, "rating": 4, "review": "Review", "createdAt": datetime(2022, 10, 1)}
+    await db.reviews.insert_one(dict(review))
+    try:
+        # A review that was counted but is not stored
+        await update_book_stats(db=db, reviews=[review, {"bookId": 53, "rating": 0, "createdAt": datetime(2022, 8, 1)}])
+        await recompute_book_stats(db=db, bookId=53)
+        stats = await db.bookStats.find_one({"_id": 53})
+        assert stats["count"] == 1
+        assert stats["rating"] == 4
+        rollups = [rollup async for rollup in db.bookMonthlyStats.find({"bookId": 53})]
+        assert [(rollup["month"], rollup["count"]) for rollup in rollups] == [(10, 1)]
+
+        await db.reviews.delete_many({"bookId": 53})
+        await recompute_book_stats(db=db, bookId=53)
+        assert await db.bookStats.find_one({"_id": 53}) is None
+        assert await db.bookMonthlyStats.count_documents({"bookId": 53}) == 0
+    finally:
+        await db.reviews.delete_many({"bookId": 53})
+        await rebuild_book_stats(db)
+
+
+@pytest.mark.asyncio
+async def test_rebuild_book_stats_checks_slow_aggregations(mongoSession, monkeypatch):
+    """
+    Tests that the aggregations of the rebuild are checked for the slow query log
+    """
+    db = mongoSession.client.get_default_database()
+    checked = []
+    monkeypatch.setattr(utils, "check_slow_aggregation",
+                        lambda collection, pipeline, duration: checked.append((collection.name, pipeline)))
+    await rebuild_book_stats(db)
+    assert checked == [("reviews", get_book_stats_pipeline()), ("reviews", get_book_monthly_stats_pipeline())]
@@ -0,0 +1,76 @@
+import asyncio
+import time
+import aiohttp
+import pytest
+from ..Config import Config
+from ..cache import SearchCache, search_cache
+from ..crud.utils import TitleMatcher, filter_title, get_book_pages, get_books_page, normalize_title
+from ..gutendex import gutendex_client
+
+
+def test_normalize_title():
+    assert normalize_title("Café Society") == "cafe society"
+    assert normalize_title("Die Straße") == "die strasse"
+    assert normalize_title("Plain Title") == "plain title"
+    # A combining mark outside the basic multilingual plane
+    assert normalize_title("Mu\U0001d167sic") == "music"
+
+
+def test_title_matcher():
+    """
+    Tests that the title matcher accepts what filter_title accepts, ignoring the accents too
+    """
+    books = [{"id": id, "title": title} for id, title in enumerate([
+        "A book with title", "No remorse", "Title of a Book", "Café Society", "Cafe Society"])]
+    for search in ["book title", "BOOK", "  title   a ", "remorse", "missing"]:
+        assert TitleMatcher(search).filter(books) == [
+            book for book in books if filter_title(title=book["title"], search_string=search.strip())]
+    assert [book["id"] for book in TitleMatcher("cafe").filter(books)] == [3, 4]
+    assert [book["id"] for book in TitleMatcher("Café society").filter(books)] == [3, 4]
+    assert TitleMatcher("").filter(books) == books
+
+
+@pytest.mark.asyncio
+async def test_book_pages_bounded_read_ahead(aioresponses, monkeypatch):
+    """
+    Tests that at most GUTENDEX_CONCURRENCY pages are fetched ahead of the consumer
+    """
+    url = "{}/?search=Read ahead".format(Config.GUTENDEX_URL)
+    for page in range(1, 11):
+        aioresponses.get(url + ("&page={}".format(page) if page > 1 else ""), status=200, payload={
+            "count": 20,
+            "next": "{}&page={}".format(url, page + 1) if page < 10 else None,
+            "previous": None,
+            "results": [{"id": page * 2}, {"id": page * 2 + 1}]
+        })
+    monkeypatch.setattr(Config, "GUTENDEX_CONCURRENCY", 2)
+    async with aiohttp.ClientSession() as session:
+        pages = get_book_pages(url=url, aiohttpSession=session, parallel=True)
+        assert [book["id"] for book in await pages.__anext__()] == [2, 3]
+        assert [book["id"] for book in await pages.__anext__()] == [4, 5]
+        await asyncio.sleep(0.05)
+        # The first page, the yielded second page and two pages ahead
+        assert len(aioresponses.requests) == 4
+        assert [[book["id"] for book in books] async for books in pages] == [
+            [page * 2, page * 2 + 1] for page in range(3, 11)]
+    assert len(aioresponses.requests) == 10
+
+
+@pytest.mark.asyncio
+async def test_stale_search_page_not_cached_again(aioresponses, monkeypatch):
+    """
+    Tests that an expired search page served while gutendex is unavailable is not cached again,
+    so the page is fetched as soon as gutendex is back, and its size is still counted
+    """
+    url = "{}/?search=Stale".format(Config.GUTENDEX_URL)
+    key = SearchCache.key(search="Stale", page=1)
+    search_cache.cache.set(key, {"count": 1, "results": [{"id": 1}]}, size=100)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + search_cache.cache.ttl + 1)
+    monkeypatch.setattr(gutendex_client, "retries", 0)
+    aioresponses.get(url, status=503)
+    async with aiohttp.ClientSession() as session:
+        assert (await get_books_page(url=url, aiohttpSession=session))["results"] == [{"id": 1}]
+        assert search_cache.cache.bytes == 100
+        aioresponses.get(url, status=200, payload={"count": 1, "results": [{"id": 2}]})
+        assert (await get_books_page(url=url, aiohttpSession=session))["results"] == [{"id": 2}]
@@ -21,3 +21,15 @@ db.createUser({
     'readWrite'  
   ],
 });
+
+db = db.getSiblingDB('gutendexerBench')
+
+db.createCollection('reviews');
+
+db.createUser({
+  user: 'api',
+  pwd: 'apiPassword',
+  roles: [
+    'readWrite'  
+  ],
+});